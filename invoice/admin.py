@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
 from django.conf.urls import patterns, url
 
 from invoice.models import Invoice, InvoiceItem, Currency, InvoicePayment,\
-    Export
+    Export, SendJob, SendAttempt, defer_invoice_recompute
 from invoice.views import pdf_dl_view, pdf_gen_view, export_view,\
-    export_test_view
+    export_test_view, export_status_view, export_status_json_view
 from invoice.forms import InvoiceAdminForm
-from invoice.admin_actions import send_invoice, generate_credit_note
+from invoice.admin_actions import send_invoice, generate_credit_note,\
+    rollback_export, print_run_pdf, print_run_zip
+from invoice.pagination import EstimatedCountPaginator
+
+SEEK_VAR = 'after'
 
 
 class InvoiceItemInline(admin.TabularInline):
@@ -18,6 +25,68 @@ class InvoicePaymentInline(admin.TabularInline):
     model = InvoicePayment
 
 
+def parse_seek_key(value):
+    """
+    :return: tuple (invoice_date, pk) from ``<invoice_date>_<pk>``, or None
+    """
+    try:
+        invoice_date, pk = value.split('_')
+        return datetime.strptime(invoice_date, '%Y-%m-%d').date(), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+class InvoiceChangeList(ChangeList):
+    """
+    Adds keyset pages to the changelist sorted in the default ordering:
+    ``?after=<invoice_date>_<pk>`` lists the invoices following that one,
+    read from the index without OFFSET nor COUNT(*) of the rows before.
+    """
+    def __init__(self, request, *args, **kwargs):
+        self.seek_key = parse_seek_key(request.GET.get(SEEK_VAR))
+        self.next_seek_url = None
+        super(InvoiceChangeList, self).__init__(request, *args, **kwargs)
+        # The filter, sort and page links start from the first page again
+        self.params.pop(SEEK_VAR, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(InvoiceChangeList, self).get_filters_params(
+            params)
+        lookup_params.pop(SEEK_VAR, None)
+        return lookup_params
+
+    def seekable(self):
+        return ORDER_VAR not in self.params
+
+    def get_queryset(self, request):
+        queryset = super(InvoiceChangeList, self).get_queryset(request)
+        self.unseeked_queryset = queryset
+        if self.seek_key is not None and self.seekable():
+            queryset = queryset.seek(*self.seek_key)
+        return queryset
+
+    def get_results(self, request):
+        if self.seek_key is None or not self.seekable():
+            super(InvoiceChangeList, self).get_results(request)
+        else:
+            self.paginator = self.model_admin.get_paginator(
+                request, self.unseeked_queryset, self.list_per_page)
+            self.result_count = self.paginator.count
+            self.full_result_count = self.model_admin.get_paginator(
+                request, self.root_queryset, self.list_per_page).count
+            self.result_list = self.queryset[:self.list_per_page]
+            self.can_show_all = False
+            self.multi_page = True
+
+        if self.multi_page and self.seekable():
+            keys = list(self.result_list.values_list('invoice_date', 'pk'))
+            if len(keys) == self.list_per_page:
+                self.next_seek_url = self.get_query_string(
+                    {SEEK_VAR: '%s_%s' % (keys[-1][0].isoformat(),
+                                          keys[-1][1])},
+                    [PAGE_VAR])
+
+
 class InvoiceAdmin(admin.ModelAdmin):
     inlines = [InvoiceItemInline, InvoicePaymentInline, ]
     fieldsets = [
@@ -55,7 +124,25 @@ class InvoiceAdmin(admin.ModelAdmin):
         'invoiced',
     )
     form = InvoiceAdminForm
-    actions = [send_invoice, generate_credit_note, ]
+    actions = [send_invoice, generate_credit_note, print_run_pdf,
+               print_run_zip, ]
+    paginator = EstimatedCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        return InvoiceChangeList
+
+    def get_queryset(self, request):
+        qs = super(InvoiceAdmin, self).get_queryset(request)
+        # The list columns read the stored totals and the joined rows, not
+        # one query per row
+        return qs.select_related('recipient', 'currency', 'invoice_related',
+                                 'credit_note')
+
+    def save_related(self, request, form, formsets, change):
+        # Update the totals once, not once per inline
+        with defer_invoice_recompute():
+            super(InvoiceAdmin, self).save_related(request, form, formsets,
+                                                   change)
 
     def has_delete_permission(self, request, obj=None):
         return False
@@ -80,24 +167,66 @@ class InvoiceAdmin(admin.ModelAdmin):
 
 class ExportAdmin(admin.ModelAdmin):
     list_display = (
-        'pk', 'date',
+        'pk', 'date', 'mode', 'status', 'progress', 'rows_done', 'file_link',
     )
-    readonly_fields = ['date', 'file_link', ]
+    list_filter = ['status', 'mode', ]
+    readonly_fields = ['date', 'mode', 'watermark', 'file_link', 'status',
+                       'progress', 'rows_done', 'rows_total',
+                       'rows_per_second', 'error', 'start_date',
+                       'finish_date', ]
     exclude = ['file', ]
+    actions = [rollback_export, ]
 
     def get_urls(self):
         urls = super(ExportAdmin, self).get_urls()
         wrapped_export_view = self.admin_site.admin_view(export_view)
         wrapped_export_test_view = self.admin_site.admin_view(export_test_view)
+        wrapped_export_status_view = self.admin_site.admin_view(
+            export_status_view)
+        wrapped_export_status_json_view = self.admin_site.admin_view(
+            export_status_json_view)
         urls = patterns(
             '',
             url(r'^do_it/$', wrapped_export_view, name='export_accounts'),
+            url(r'^do_it/delta/$', wrapped_export_view, {'mode': 'delta'},
+                name='export_accounts_delta'),
+            url(r'^do_it/(\d+)/status/$', wrapped_export_status_view,
+                name='export_status'),
+            url(r'^do_it/(\d+)/status\.json$',
+                wrapped_export_status_json_view, name='export_status_json'),
             url(r'^do_it/test$', wrapped_export_test_view,
                 name='export_accounts_test'),
         ) + urls
         return urls
 
 
+class SendAttemptInline(admin.TabularInline):
+    model = SendAttempt
+    fields = ['invoice', 'status', 'tries', 'error', 'next_try', ]
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def get_queryset(self, request):
+        # Only the attempts which need attention
+        qs = super(SendAttemptInline, self).get_queryset(request)
+        return qs.exclude(status='sent')
+
+
+class SendJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'pk', 'creation_date', 'status', 'sent_count', 'failed_count',
+        'finish_date',
+    )
+    readonly_fields = ['status', 'last_invoice', 'sent_count',
+                       'failed_count', 'finish_date', ]
+    inlines = [SendAttemptInline, ]
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(Invoice, InvoiceAdmin)
 admin.site.register(Currency)
 admin.site.register(Export, ExportAdmin)
+admin.site.register(SendJob, SendJobAdmin)
@@ -3,13 +3,20 @@ from django.utils.translation import ugettext_lazy as _
 from django.shortcuts import redirect
 from django.core import urlresolvers
 from django.contrib import messages
+from django.http import StreamingHttpResponse
 
-from invoice.models import Invoice, InvoiceItem
+from invoice.models import Invoice, InvoiceItem, defer_invoice_recompute
+from invoice.mailing import send_invoices
+from invoice.print_run import VOLUME_SIZE, write_merged_pdf, iter_invoices,\
+    iter_zip, iter_pdf_entries, iter_volume_entries
+from invoice.utils import buffer_response
+from invoice.utils.buffers import SpooledBuffer
 
 
 def send_invoice(self, request, queryset):
-    for invoice in queryset.all():
-        invoice.send_invoice()
+    sent = send_invoices(queryset)
+    messages.add_message(request, messages.INFO,
+                         _(u"%d invoice(s) sent.") % sent)
 send_invoice.short_description = _(u"Send invoice to client")
 
 
@@ -37,15 +44,53 @@ def generate_credit_note(self, request, queryset):
                               invoice_cost_code=invoice.invoice_cost_code)
         credit_note.save()
         last_credite_note_created = credit_note
-        for invoice_item in invoice.items.all():
-            item = InvoiceItem(invoice=credit_note,
-                               description=invoice_item.description,
-                               unit_price=invoice_item.unit_price,
-                               quantity=invoice_item.quantity)
-            item.save()
+        with defer_invoice_recompute():
+            for invoice_item in invoice.items.all():
+                item = InvoiceItem(invoice=credit_note,
+                                   description=invoice_item.description,
+                                   unit_price=invoice_item.unit_price,
+                                   quantity=invoice_item.quantity)
+                item.save()
     if last_credite_note_created:
         change_url = urlresolvers.reverse(
             'admin:invoice_invoice_change',
             args=(last_credite_note_created.pk,))
         return redirect(change_url)
 generate_credit_note.short_description = _(u"Generate credit note")
+
+
+def rollback_export(self, request, queryset):
+    count = 0
+    for export in queryset:
+        export.rollback()
+        count += 1
+    messages.add_message(request, messages.INFO,
+                         _(u"%d export(s) rolled back.") % count)
+rollback_export.short_description = _(u"Roll back the export")
+
+
+def _zip_response(entries, file_name):
+    # Each entry is sent as soon as it is drawn
+    response = StreamingHttpResponse(iter_zip(entries),
+                                     content_type='application/zip')
+    response["Content-Disposition"] = "attachment; filename=\"%s\"" %\
+        file_name
+    return response
+
+
+def print_run_pdf(self, request, queryset):
+    invoices = iter_invoices(queryset)
+    if queryset.count() > VOLUME_SIZE:
+        # ReportLab keeps a whole PDF in memory: a ZIP of the volumes
+        return _zip_response(iter_volume_entries(invoices, 'invoices.pdf'),
+                             'invoices.zip')
+    output = SpooledBuffer()
+    write_merged_pdf(invoices, output)
+    return buffer_response(output, 'invoices.pdf')
+print_run_pdf.short_description = _(u"Print run (merged PDF)")
+
+
+def print_run_zip(self, request, queryset):
+    return _zip_response(iter_pdf_entries(iter_invoices(queryset)),
+                         'invoices.zip')
+print_run_zip.short_description = _(u"Print run (ZIP of PDFs)")
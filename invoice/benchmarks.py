@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks, run with ``python manage.py invoice_benchmark <name>``.
+
+A benchmark is a function registered with ``@benchmark``, it takes the
+``write`` function of the command and its options.
+"""
+import random
+from StringIO import StringIO
+from datetime import date, timedelta
+from time import time
+
+from django.db import connection
+
+from .models import Invoice, InvoiceSequence, atomic
+from .pagination import estimated_count
+from .pdf import draw_pdf
+from .conf import settings as app_settings
+from .utils import friendly_id
+
+BENCHMARKS = {}
+
+# The invoices of the fixture, ``invoice_id`` is B followed by 9 digits
+FIXTURE_COST_CODE = 'BENCHMARK'
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, repeat=5):
+    """
+    :return: the best time of ``repeat`` calls of ``func``, in seconds
+    """
+    timings = []
+    for i in range(repeat):
+        start = time()
+        func()
+        timings.append(time() - start)
+    return min(timings)
+
+
+def explain(queryset):
+    """
+    :return: the query plan of ``queryset`` as a list of lines
+    """
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [u" ".join([u"%s" % column for column in row])
+            for row in cursor.fetchall()]
+
+
+def make_fixture(size, recipient, chunk_size=5000):
+    """
+    Adds fixture invoices until there are ``size`` of them. Their dates
+    spread over the last five years, most of them are invoiced, paid and
+    exported: run it in a test database only (``invoice_benchmark
+    --fixture`` creates one), they would be sent and exported like the
+    real ones.
+
+    :return: the number of invoices created
+    """
+    fixture = Invoice.objects.filter(invoice_cost_code=FIXTURE_COST_CODE)
+    first = fixture.count()
+    rand = random.Random(first)
+    today = date.today()
+    # InvoiceSequence seeds a missing counter from the Max() of the existing
+    # invoices: create them from the real invoices first, so the fixture
+    # never moves the numbering of the real ones
+    real = Invoice.objects.exclude(invoice_cost_code=FIXTURE_COST_CODE)
+    first_year = (today - timedelta(days=5 * 365)).year
+    for year in [InvoiceSequence.objects.SERIAL] + \
+            range(first_year, today.year + 1):
+        InvoiceSequence.objects.ensure(year, real)
+    created = 0
+    for start in range(first, size, chunk_size):
+        invoices = []
+        for i in range(start, min(start + chunk_size, size)):
+            invoice_date = today - timedelta(days=rand.randint(0, 5 * 365))
+            invoices.append(Invoice(
+                recipient=recipient,
+                invoice_id=u'B%09d' % i,
+                number=i + 1,
+                invoice_date=invoice_date,
+                invoice_cost_code=FIXTURE_COST_CODE,
+                invoiced=rand.random() < 0.9,
+                draft=rand.random() < 0.02,
+                is_paid=rand.random() < 0.85,
+                is_exported=rand.choice(('yes',) * 18 +
+                                        ('invoice_only', 'no'))))
+        with atomic():
+            Invoice.objects.bulk_create(invoices)
+        created += len(invoices)
+    return created
+
+
+def delete_fixture():
+    """
+    Deletes the fixture invoices, for instance those left in a database by
+    an earlier version of ``invoice_benchmark``.
+    """
+    # The fixture invoices have no related rows, a plain DELETE is enough
+    # and does not load a million invoices
+    cursor = connection.cursor()
+    with atomic():
+        cursor.execute('DELETE FROM %s WHERE invoice_cost_code = %%s' %
+                       connection.ops.quote_name(Invoice._meta.db_table),
+                       [FIXTURE_COST_CODE])
+
+
+def _run_queries(write, queries, repeat):
+    for name, queryset in queries:
+        seconds = timed(lambda: list(queryset), repeat)
+        write(u"%s: %.1f ms" % (name, seconds * 1000))
+        for line in explain(queryset):
+            write(u"    %s" % line)
+
+
+def _pks(queryset):
+    return queryset.values_list('pk', flat=True)
+
+
+@benchmark
+def queries(write, repeat=5, **options):
+    """
+    The query plans and timings of the manager queries: due invoices, the
+    export, the numbers of a year and the admin filters.
+    """
+    year = date.today().year
+    _run_queries(write, [
+        ('get_due', _pks(Invoice.objects.get_due().order_by())),
+        ('export', _pks(Invoice.objects.filter(is_exported='no')
+                        .order_by('pk'))[:1000]),
+        ('year_last_number', _pks(Invoice.objects.filter(
+            invoice_date__year=year).order_by('-number'))[:1]),
+        ('unpaid', _pks(Invoice.objects.filter(is_paid=False))[:100]),
+        ('credit_notes', _pks(Invoice.objects.filter(
+            is_credit_note=True))[:100]),
+    ], repeat)
+
+
+@benchmark
+def pages(write, repeat=5, page_size=100, **options):
+    """
+    A late page of the invoice list in the default ordering: OFFSET against
+    Invoice.objects.seek(), and COUNT(*) against the planner estimate.
+    """
+    invoices = Invoice.objects.order_by('-invoice_date', 'id')
+    offset = max(invoices.count() - page_size, 0)
+    last = list(invoices.values_list('invoice_date', 'pk')[offset:offset + 1])
+    if not last:
+        write(u"No invoices")
+        return
+    _run_queries(write, [
+        ('offset', _pks(invoices)[offset:offset + page_size]),
+        ('seek', _pks(Invoice.objects.seek(*last[0]))[:page_size]),
+    ], repeat)
+    seconds = timed(lambda: Invoice.objects.count(), repeat)
+    write(u"count: %.1f ms" % (seconds * 1000))
+    seconds = timed(lambda: estimated_count(Invoice.objects.all()), repeat)
+    write(u"estimated_count: %.1f ms (%s)" % (
+        seconds * 1000, estimated_count(Invoice.objects.all())))
+
+
+@benchmark
+def pdf(write, repeat=5, count=50, **options):
+    """
+    Draws the PDF of ``count`` invoices with and without
+    INV_PDF_CACHE_STATIC: time and size per PDF.
+    """
+    invoices = list(Invoice.objects.select_related('currency')
+                    .prefetch_related('items')[:count])
+    if not invoices:
+        write(u"No invoices")
+        return
+    cache_static = app_settings.INV_PDF_CACHE_STATIC
+    try:
+        for cached in (False, True):
+            app_settings.INV_PDF_CACHE_STATIC = cached
+            sizes = []
+
+            def draw_all():
+                del sizes[:]
+                for invoice in invoices:
+                    output = StringIO()
+                    if draw_pdf(output, invoice) is False:
+                        raise Exception(u"The PDF of %s cannot be drawn" %
+                                        invoice.invoice_id)
+                    sizes.append(len(output.getvalue()))
+
+            seconds = timed(draw_all, repeat)
+            write(u"INV_PDF_CACHE_STATIC=%s: %.1f ms, %d bytes per PDF" % (
+                cached, seconds * 1000 / len(invoices),
+                sum(sizes) / len(sizes)))
+    finally:
+        app_settings.INV_PDF_CACHE_STATIC = cache_static
+
+
+@benchmark
+def ids(write, repeat=5, count=100000, **options):
+    """
+    Encodes and decodes ``count`` invoice IDs of ``invoice.utils.friendly_id``
+    one by one and with encode_many()/decode_many().
+    """
+    step = max(friendly_id.SIZE // count, 1)
+    serials = range(0, friendly_id.SIZE + 1, step)[:count]
+    strings = friendly_id.encode_many(serials)
+    for name, func in [
+            ('encode', lambda: [friendly_id.encode(serial)
+                                for serial in serials]),
+            ('encode_many', lambda: friendly_id.encode_many(serials)),
+            ('decode', lambda: [friendly_id.decode(string)
+                                for string in strings]),
+            ('decode_many', lambda: friendly_id.decode_many(strings))]:
+        seconds = timed(func, repeat)
+        write(u"%s: %.2f us per ID" % (name, seconds * 1000000 / len(serials)))
@@ -20,3 +20,51 @@ INV_NAME_MODULE = getattr(settings, 'INV_NAME_MODULE',
                           'invoice.utils.naming')
 INV_EXPORT_MODULE = getattr(settings, 'INV_EXPORT_MODULE',
                             'invoice.export_example')
+# Format of the export files: csv, csv.gz, jsonl or fec
+INV_EXPORT_FORMAT = getattr(settings, 'INV_EXPORT_FORMAT', 'csv')
+# Delta exports leave out the rows modified in the last seconds, their
+# transaction may not be committed yet
+INV_EXPORT_DELTA_LAG = getattr(settings, 'INV_EXPORT_DELTA_LAG', 60)
+# A running export which saved no progress for this number of seconds lost
+# its worker: its rows are released and it is queued again (None: never)
+INV_EXPORT_STALE_AFTER = getattr(settings, 'INV_EXPORT_STALE_AFTER', 3600)
+INV_IMPORT_CHUNK_SIZE = getattr(settings, 'INV_IMPORT_CHUNK_SIZE', 500)
+# Number of processes used to generate PDFs in batch (default: CPU count)
+INV_PDF_PROCESSES = getattr(settings, 'INV_PDF_PROCESSES', None)
+INV_PDF_CHUNK_SIZE = getattr(settings, 'INV_PDF_CHUNK_SIZE', 100)
+# PDF cache, set INV_PDF_CACHE_BACKEND to None to disable it
+INV_PDF_CACHE_BACKEND = getattr(settings, 'INV_PDF_CACHE_BACKEND',
+                                'invoice.pdf_cache.FileSystemPDFCache')
+INV_PDF_CACHE_OPTIONS = getattr(settings, 'INV_PDF_CACHE_OPTIONS', {})
+# Change it when the PDF layout changes to invalidate the cached PDFs
+INV_PDF_TEMPLATE_VERSION = getattr(settings, 'INV_PDF_TEMPLATE_VERSION', '1')
+# Draw the static parts of the PDF (header, footer, address) once per PDF
+# and decode the logo once per process
+INV_PDF_CACHE_STATIC = getattr(settings, 'INV_PDF_CACHE_STATIC', True)
+# PDFs bigger than this (bytes) are spooled to a temporary file on their way
+# to a response, an e-mail or the PDF cache instead of being kept in memory
+INV_PDF_SPOOL_SIZE = getattr(settings, 'INV_PDF_SPOOL_SIZE', 1024 * 1024)
+# How the PDF downloads are served: 'django', 'xsendfile' (Apache
+# mod_xsendfile, lighttpd) or 'xaccel' (nginx X-Accel-Redirect)
+INV_SERVE_BACKEND = getattr(settings, 'INV_SERVE_BACKEND', 'django')
+# nginx internal location mapped to INV_PDF_DIR
+INV_SERVE_XACCEL_PREFIX = getattr(settings, 'INV_SERVE_XACCEL_PREFIX',
+                                  '/protected/invoices/')
+# Number of e-mails sent through one SMTP connection call
+INV_EMAIL_BATCH_SIZE = getattr(settings, 'INV_EMAIL_BATCH_SIZE', 100)
+# Processes rendering the PDFs ahead of the sender (1: no pool)
+INV_EMAIL_PROCESSES = getattr(settings, 'INV_EMAIL_PROCESSES', 1)
+# Number of e-mail inline images kept in memory
+INV_EMAIL_IMAGE_CACHE_SIZE = getattr(settings, 'INV_EMAIL_IMAGE_CACHE_SIZE',
+                                     16)
+# send_invoices command
+INV_SEND_RATE = getattr(settings, 'INV_SEND_RATE', None)  # e-mails/second
+INV_SEND_CONCURRENCY = getattr(settings, 'INV_SEND_CONCURRENCY', 1)
+INV_SEND_MAX_TRIES = getattr(settings, 'INV_SEND_MAX_TRIES', 5)
+INV_SEND_RETRY_DELAY = getattr(settings, 'INV_SEND_RETRY_DELAY', 60)  # seconds
+# The admin changelist shows the planner estimate instead of COUNT(*) for the
+# unfiltered invoices above this number (PostgreSQL and MySQL), None to
+# always count
+INV_ADMIN_ESTIMATE_COUNT_ABOVE = getattr(settings,
+                                         'INV_ADMIN_ESTIMATE_COUNT_ABOVE',
+                                         100000)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable sending of the due invoices, see ``run_send_job``.
+"""
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.core.mail import get_connection
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from .conf import settings as inv_settings
+from .mailing import build_invoice_email
+from .models import Invoice, SendJob, SendAttempt, atomic
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls to ``wait`` to stay under ``rate`` calls per second.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        if self.next_call > now:
+            time.sleep(self.next_call - now)
+            now = self.next_call
+        self.next_call = now + self.interval
+
+
+class MessageSender(object):
+    """
+    Sends e-mails from a pool of threads, each thread keeping its own mail
+    connection open.
+    """
+    def __init__(self, concurrency=1):
+        self.pool = ThreadPool(concurrency)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def submit(self, message):
+        """
+        :return: AsyncResult, its value is None once the message is sent,
+            or the error message
+        """
+        return self.pool.apply_async(self._send, (message, ))
+
+    def _send(self, message):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = get_connection()
+            with self.lock:
+                self.connections.append(connection)
+        try:
+            connection.open()
+            if not connection.send_messages([message]):
+                return u"The e-mail has not been sent"
+        except Exception, e:
+            logger.exception(u"Cannot send %s" % message.subject)
+            # Start again with a new connection
+            self.local.connection = None
+            try:
+                connection.close()
+            except Exception:
+                pass
+            return u"%s" % e
+        return None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for connection in self.connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+def run_send_job(job=None, chunk_size=None, rate=None, concurrency=None,
+                 max_tries=None, retry_delay=None, progress=None, **kwargs):
+    """
+    Sends the due invoices by e-mail, ``chunk_size`` (default:
+    ``INV_EMAIL_BATCH_SIZE``) at a time, at most ``rate`` e-mails per second
+    from ``concurrency`` threads. Failed e-mails are tried ``max_tries``
+    times, waiting ``retry_delay`` seconds, then twice as long each time.
+
+    The progress is stored in ``job`` (default: the last unfinished job, or
+    a new one), so a stopped job goes on where it stopped: the due invoices
+    are read after the last one queued, and an e-mail which may have been
+    sent is never sent again (its attempt is left in the ``unknown``
+    state). ``progress`` is called with the job after each chunk. Other
+    keyword arguments are passed to ``build_invoice_email``.
+
+    :return: SendJob
+    """
+    chunk_size = chunk_size or inv_settings.INV_EMAIL_BATCH_SIZE
+    rate = rate or inv_settings.INV_SEND_RATE
+    concurrency = concurrency or inv_settings.INV_SEND_CONCURRENCY
+    max_tries = max_tries or inv_settings.INV_SEND_MAX_TRIES
+    if retry_delay is None:
+        retry_delay = inv_settings.INV_SEND_RETRY_DELAY
+
+    if job is None:
+        jobs = list(SendJob.objects.filter(status='running')[:1])
+        job = jobs[0] if jobs else SendJob.objects.create()
+    job.attempts.filter(status='sending').update(status='unknown')
+
+    limiter = RateLimiter(rate)
+    sender = MessageSender(concurrency)
+    try:
+        while True:
+            attempts = _next_attempts(job, chunk_size, max_tries)
+            if attempts:
+                _send_attempts(job, attempts, limiter, sender, max_tries,
+                               retry_delay, kwargs)
+                if progress:
+                    progress(job)
+                continue
+
+            next_try = job.attempts.filter(
+                status='failed', tries__lt=max_tries).aggregate(
+                next_try=Min('next_try'))['next_try']
+            if next_try is None:
+                break
+            delay = (next_try - timezone.now()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        sender.close()
+
+    job.status = 'done'
+    job.finish_date = timezone.now()
+    job.save()
+    return job
+
+
+def _next_attempts(job, chunk_size, max_tries):
+    attempt_qs = job.attempts.select_related('invoice__recipient',
+                                             'invoice__currency')\
+        .order_by('pk')
+
+    while True:
+        # The attempts queued before the job stopped, and the retries
+        attempts = list(attempt_qs.filter(
+            Q(status='queued') |
+            Q(status='failed', tries__lt=max_tries,
+              next_try__lte=timezone.now()))[:chunk_size])
+        if not attempts:
+            break
+        # Their invoice may have been sent since, by another way
+        invoiced = [attempt.pk for attempt in attempts
+                    if attempt.invoice.invoiced]
+        if not invoiced:
+            return attempts
+        SendAttempt.objects.filter(pk__in=invoiced).update(
+            status='sent', error=u"Already invoiced")
+        attempts = [attempt for attempt in attempts
+                    if not attempt.invoice.invoiced]
+        if attempts:
+            return attempts
+
+    pks = list(Invoice.objects.get_due()
+               .filter(pk__gt=job.last_invoice)
+               .exclude(send_attempts__status__in=('sending', 'unknown'))
+               .order_by('pk')
+               .values_list('pk', flat=True)[:chunk_size])
+    if not pks:
+        return []
+    with atomic():
+        SendAttempt.objects.bulk_create([SendAttempt(job=job, invoice_id=pk)
+                                         for pk in pks])
+        job.last_invoice = pks[-1]
+        job.save()
+    return list(attempt_qs.filter(invoice__in=pks))
+
+
+def _send_attempts(job, attempts, limiter, sender, max_tries, retry_delay,
+                   email_kwargs):
+    results = []
+    for attempt in attempts:
+        email = build_invoice_email(attempt.invoice, **email_kwargs)
+        if email is None:
+            results.append((attempt, None))
+            continue
+        limiter.wait()
+        SendAttempt.objects.filter(pk=attempt.pk).update(status='sending')
+        results.append((attempt, sender.submit(email)))
+
+    sent = []
+    for attempt, result in results:
+        if result is None:
+            # Nothing to retry
+            attempt.tries = max_tries
+            attempt.error = u"No recipient e-mail or PDF"
+        else:
+            attempt.tries += 1
+            attempt.error = result.get()
+            if attempt.error is None:
+                sent.append(attempt)
+                continue
+        attempt.status = 'failed'
+        attempt.next_try = timezone.now() + timedelta(
+            seconds=retry_delay * 2 ** (attempt.tries - 1))
+        attempt.save()
+        if attempt.tries >= max_tries:
+            job.failed_count += 1
+
+    with atomic():
+        SendAttempt.objects.filter(pk__in=[a.pk for a in sent]).update(
+            status='sent', tries=F('tries') + 1, error='')
+        Invoice.objects.filter(pk__in=[a.invoice_id for a in sent]).update(
+            invoiced=True)
+        job.sent_count += len(sent)
+        job.save()
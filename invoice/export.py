@@ -3,38 +3,228 @@ from django.conf import settings
 from django.utils.text import get_valid_filename
 from django.core.files.storage import FileSystemStorage
 from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
 try:
     from django.utils import importlib
 except ImportError:
     import importlib
 
 import csv
-from datetime import datetime, date
-from os.path import join, split
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from gzip import GzipFile
+from inspect import getmro
+from itertools import chain, izip
+from os import remove
+from os.path import join, split, exists
+from time import time
 
-from .models import Export
+from .models import Export, Invoice, InvoicePayment, atomic
 from .conf import settings as inv_settings
 
 import logging
 logger = logging.getLogger(__name__)
 
+WRITE_BUFFER_SIZE = 256 * 1024
+# The progress of a running export is saved every PROGRESS_EVERY rows
+PROGRESS_EVERY = 1000
+
 
 def export(test=True):
-    data = gather_data_and_update_flags(test)
-    if data == []:
-        raise Exception(u"%s" % _(u"No data to export!"))
-    elif not data:
-        logger.error(u"%s" % _(u"Error when fetching data - Data empty."))
-        raise Exception(u"%s" % _(u"Error when fetching data"
-                                  u" Export cancelled!"))
+    """
+    Runs an export in the current process.
+
+    :return: the URL of the file
+    """
+    if not test:
+        # Created running, a worker never claims it
+        export = Export.objects.create(date=date.today(), status='running',
+                                       start_date=timezone.now())
+        run_export(export)
+        if export.status == 'failed':
+            raise Exception(export.error)
+        return settings.MEDIA_URL + export.file.name
+
+    data_module = get_export_module()
+    if hasattr(data_module, 'gather_data'):
+        rows = gather_rows(data_module, *exportable(data_module))
+    else:
+        rows = check_rows(data_module.gather_data_and_update_flags(test))
+    mediafilepath = available_file_name(test)
+    write_rows(join(settings.MEDIA_ROOT, mediafilepath), rows)
+    return settings.MEDIA_URL + mediafilepath
+
+
+def queue_export(mode='flags'):
+    """
+    :param mode: ``flags`` exports the rows not exported yet, ``delta`` the
+        rows modified since the last delta export
+    :return: a new pending export, run by the ``run_export_worker`` command
+    """
+    return Export.objects.create(date=date.today(), status='pending',
+                                 mode=mode)
+
+
+def recover_stale_exports():
+    """
+    Queues again the running exports which saved no progress for
+    ``INV_EXPORT_STALE_AFTER`` seconds (their worker was killed or crashed),
+    after marking the rows they claimed as not exported.
+
+    :return: the number of exports queued again
+    """
+    if not inv_settings.INV_EXPORT_STALE_AFTER:
+        return 0
+    cutoff = timezone.now() - timedelta(
+        seconds=inv_settings.INV_EXPORT_STALE_AFTER)
+    recovered = 0
+    for export in Export.objects.filter(status='running',
+                                        modification_date__lt=cutoff):
+        with atomic():
+            # Only one worker gets the row back
+            if Export.objects.filter(
+                    pk=export.pk, status='running',
+                    modification_date__lt=cutoff).update(
+                    status='pending', rows_done=0, start_date=None,
+                    modification_date=timezone.now()):
+                logger.warning(u"Export %s stalled, queued again" %
+                               export.pk)
+                export.release()
+                recovered += 1
+    return recovered
+
+
+def claim_next_export():
+    """
+    :return: the oldest pending export, now running, or None
+
+    The export is claimed with an ``UPDATE ... WHERE status = 'pending'``,
+    several workers never run the same export. The stale exports are
+    queued again first.
+    """
+    recover_stale_exports()
+    while True:
+        pks = list(Export.objects.filter(status='pending').order_by('pk')
+                   .values_list('pk', flat=True)[:1])
+        if not pks:
+            return None
+        now = timezone.now()
+        claimed = Export.objects.filter(pk=pks[0], status='pending')\
+            .update(status='running', start_date=now, modification_date=now)
+        if claimed:
+            return Export.objects.get(pk=pks[0])
+
+
+def run_export(export):
+    """
+    Marks the rows of ``export``, writes its file and saves its progress on
+    the way. If it fails, the rows are marked as not exported again and the
+    export gets the ``failed`` status.
+
+    A delta export marks nothing, it exports the rows modified since the
+    previous delta export.
+    """
+    data_module = get_export_module()
+    delta_export = export.mode == 'delta'
+    batch_export = hasattr(data_module, 'gather_data') and not delta_export
+    mediafilepath = available_file_name()
+    started = time()
+    export.status = 'running'
+    export.start_date = export.start_date or timezone.now()
+
+    def progress(rows_done):
+        elapsed = time() - started
+        export.rows_done = rows_done
+        export.rows_per_second = rows_done / elapsed if elapsed else None
+        # Do not overwrite the other fields, the export may be followed.
+        # The modification date tells recover_stale_exports() it is alive.
+        Export.objects.filter(pk=export.pk).update(
+            rows_done=export.rows_done,
+            rows_per_second=export.rows_per_second,
+            modification_date=timezone.now())
+
+    try:
+        if delta_export:
+            # Leave some time to the transactions in progress, a row saved by
+            # one of them has a modification date older than its commit
+            export.watermark = timezone.now() - timedelta(
+                seconds=inv_settings.INV_EXPORT_DELTA_LAG)
+            invoices, payments = export.changes()
+            export.rows_total = invoices.count() + payments.count()
+            Export.objects.filter(pk=export.pk).update(
+                watermark=export.watermark, rows_total=export.rows_total,
+                modification_date=timezone.now())
+            rows = gather_delta(data_module, export)
+        elif batch_export:
+            with atomic():
+                export.claim(*exportable(data_module))
+            invoices, payments = export.invoices.all(), export.payments.all()
+            export.rows_total = invoices.count() + payments.count()
+            Export.objects.filter(pk=export.pk).update(
+                rows_total=export.rows_total,
+                modification_date=timezone.now())
+            rows = gather_rows(data_module, invoices, payments)
+        else:
+            rows = check_rows(data_module.gather_data_and_update_flags(False))
+        write_rows(join(settings.MEDIA_ROOT, mediafilepath), rows, progress)
+    except Exception, e:
+        logger.exception(u"Export %s failed" % export.pk)
+        if batch_export:
+            export.release()
+        export.status = 'failed'
+        export.error = u"%s" % e
+    else:
+        export.file = mediafilepath
+        export.status = 'done'
+    export.finish_date = timezone.now()
+    export.save()
+    return export
+
 
-    # File name
+def gather_rows(data_module, invoices, payments, writer_class=None):
+    """
+    :return: the rows of a batch export: the module's function named by the
+        ``gather`` attribute of ``writer_class`` (``gather_fec`` for the FEC
+        writer), or its ``gather_data``
+    """
+    if writer_class is None:
+        writer_class = get_writer()
+    gather = getattr(data_module, writer_class.gather, None)
+    if gather is None:
+        gather = data_module.gather_data
+    return check_rows(gather(invoices, payments))
+
+
+def gather_delta(data_module, export):
+    """
+    :return: the rows of the delta ``export``: the module's
+        ``gather_delta(invoices, payments, since)``, or its ``gather_data``
+    """
+    invoices, payments = export.changes()
+    if hasattr(data_module, 'gather_delta'):
+        data = data_module.gather_delta(invoices, payments,
+                                        export.previous_watermark())
+    elif hasattr(data_module, 'gather_data'):
+        data = data_module.gather_data(invoices, payments)
+    else:
+        raise Exception(u"%s" % _(u"The export module does not support delta"
+                                  u" exports!"))
+    # Nothing changed is not an error, the watermark moves on
+    return check_rows(data, allow_empty=True)
+
+
+def available_file_name(test=False):
+    """
+    :return: the path of a new export file, relative to the MEDIA_ROOT
+    """
+    extension = get_writer().extension
     if test:
-        filename = get_valid_filename("test_%s.csv" % date.today())
+        filename = get_valid_filename("test_%s.%s" % (date.today(),
+                                                      extension))
     else:
-        filename = get_valid_filename("%s.csv" % date.today())
-    mediafilepath = join("invoices/export/", filename)
-    filepath = join(settings.MEDIA_ROOT, mediafilepath)
+        filename = get_valid_filename("%s.%s" % (date.today(), extension))
+    filepath = join(settings.MEDIA_ROOT, "invoices/export/", filename)
 
     # Ensure that we got an available file name
     fss = FileSystemStorage()
@@ -42,28 +232,295 @@ def export(test=True):
 
     # If the file name change, we update the media file path
     filename = split(filepath)[1]
-    mediafilepath = join("invoices/export/", filename)
+    return join("invoices/export/", filename)
+
+
+def rewrite(export):
+    """
+    Writes the file of ``export`` again, from the invoices and payments it
+    exported (export modules with ``gather_data`` or ``gather_delta``
+    only).
+    """
+    data_module = get_export_module()
+    writer_class = writer_for_file(export.file.name)
+    if export.mode == 'delta':
+        rows = gather_delta(data_module, export)
+    else:
+        rows = gather_rows(data_module, export.invoices.all(),
+                           export.payments.all(), writer_class)
+    write_rows(join(settings.MEDIA_ROOT, export.file.name), rows,
+               writer_class=writer_class)
+
+
+def exportable(data_module):
+    """
+    :return: tuple (invoices, payments) querysets of the rows to export
+    """
+    if hasattr(data_module, 'invoices_to_export'):
+        invoices = data_module.invoices_to_export()
+    else:
+        invoices = Invoice.objects.filter(is_exported='no')
+    if hasattr(data_module, 'payments_to_export'):
+        payments = data_module.payments_to_export()
+    else:
+        payments = InvoicePayment.objects.filter(is_exported=False)
+    return invoices, payments
+
+
+def check_rows(data, allow_empty=False):
+    """
+    :return: an iterator on the rows of ``data``, which is read only once
+        (it may be a generator)
+    """
+    if data is None or data is False:
+        logger.error(u"%s" % _(u"Error when fetching data - Data empty."))
+        raise Exception(u"%s" % _(u"Error when fetching data"
+                                  u" Export cancelled!"))
+    rows = iter(data)
+    try:
+        first_row = next(rows)
+    except StopIteration:
+        if allow_empty:
+            return iter(())
+        raise Exception(u"%s" % _(u"No data to export!"))
+    return chain([first_row], rows)
+
+
+def write_rows(filepath, rows, progress=None, writer_class=None):
+    """
+    Writes ``rows`` to ``filepath`` with ``writer_class`` (the writer of
+    INV_EXPORT_FORMAT by default). ``progress`` is called with the number of
+    rows written every PROGRESS_EVERY rows and at the end.
+    """
+    if writer_class is None:
+        writer_class = get_writer()
+    count = 0
+    try:
+        with open(filepath, "wb", WRITE_BUFFER_SIZE) as exportfile:
+            writer = writer_class(exportfile)
+            for row in rows:
+                writer.write(row)
+                count += 1
+                if progress is not None and not count % PROGRESS_EVERY:
+                    progress(count)
+            writer.close()
+        if progress is not None:
+            progress(count)
+    except:
+        # Do not leave a partial export
+        if exists(filepath):
+            remove(filepath)
+        raise
+
 
-    # Write the file on the FS, and create the Export object if we are not in
-    # test mode
-    with open(filepath, "w") as csvfile:
-        exportwriter = csv.writer(csvfile, delimiter=';',
-                                  quoting=csv.QUOTE_ALL)
+class ExportWriter(object):
+    """
+    Writes typed rows (unicode, Decimal, date...) to a binary file.
 
+    The formatter of each column is looked up from the type of its first
+    value, ``formatters`` maps a type to a function which returns the
+    formatted value.
+    """
+    extension = None
+    formatters = {}
+    # The function of the export module which gathers the rows
+    gather = 'gather_data'
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.columns = None
+
+    def write(self, row):
+        if self.columns is None:
+            self.columns = [self.column_formatter(value) for value in row]
+        self.write_fields([format_value(value) for format_value, value
+                           in izip(self.columns, row)])
+
+    def write_fields(self, fields):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def formatter(self, kind):
+        for base in getmro(kind):
+            if base in self.formatters:
+                return self.formatters[base]
+        return self.formatters[object]
+
+    def column_formatter(self, value):
+        kind = type(value)
+        format_kind = self.formatter(kind)
+
+        def format_value(value):
+            if type(value) is kind:
+                return format_kind(value)
+            # Another type in the column (None for instance)
+            return self.formatter(type(value))(value)
+        return format_value
+
+
+def _format_text(value):
+    return (u"%s" % value).strip().encode("utf-8")
+
+
+class CSVWriter(ExportWriter):
+    """
+    ``;`` separated values, all quoted, encoded in UTF-8
+    """
+    extension = 'csv'
+    formatters = {
+        object: _format_text,
+        Decimal: str,
+        int: str,
+        long: str,
+        date: lambda value: value.isoformat(),
+        datetime: str,
+    }
+
+    def __init__(self, fileobj):
+        super(CSVWriter, self).__init__(fileobj)
         # We do this because CSV doesn't support directly Unicode and UTF-8
         # http://docs.python.org/2/library/csv.html#examples
-        for row in data:
-            r = []
-            for field in row:
-                r.append(("%s" % field).strip().encode("utf-8"))
-            exportwriter.writerow(r)
+        self.csv_writer = csv.writer(fileobj, delimiter=';',
+                                     quoting=csv.QUOTE_ALL)
 
-        if not test:
-            export = Export(date=datetime.today(),
-                            file=mediafilepath)
-            export.save()
+    def write_fields(self, fields):
+        self.csv_writer.writerow(fields)
+
+
+class GzipCSVWriter(CSVWriter):
+    extension = 'csv.gz'
+    # The default level (9) is much slower for a few percents of size
+    compresslevel = 6
+
+    def __init__(self, fileobj):
+        self.gzip_file = GzipFile(mode='wb', fileobj=fileobj,
+                                  compresslevel=self.compresslevel)
+        super(GzipCSVWriter, self).__init__(self.gzip_file)
+
+    def close(self):
+        # Writes the end of the gzip stream, fileobj is not closed
+        self.gzip_file.close()
+
+
+def _json_text(value):
+    return json.dumps(u"%s" % value)
+
+
+class JSONLinesWriter(ExportWriter):
+    """
+    One JSON array per row. Decimals are written as JSON numbers with all
+    their digits, dates as ISO 8601 strings.
+    """
+    extension = 'jsonl'
+    formatters = {
+        object: _json_text,
+        type(None): lambda value: 'null',
+        bool: lambda value: 'true' if value else 'false',
+        Decimal: str,
+        int: str,
+        long: str,
+        float: repr,
+        date: lambda value: '"%s"' % value.isoformat(),
+    }
+
+    def write_fields(self, fields):
+        self.fileobj.write('[%s]\n' % ','.join(fields))
+
+
+# Columns of the "Fichier des Écritures Comptables" (article A47 A-1 of the
+# Livre des procédures fiscales)
+FEC_COLUMNS = (
+    'JournalCode', 'JournalLib', 'EcritureNum', 'EcritureDate', 'CompteNum',
+    'CompteLib', 'CompAuxNum', 'CompAuxLib', 'PieceRef', 'PieceDate',
+    'EcritureLib', 'Debit', 'Credit', 'EcritureLet', 'DateLet', 'ValidDate',
+    'Montantdevise', 'Idevise',
+)
 
-    return settings.MEDIA_URL + mediafilepath
+
+def _fec_text(value):
+    value = u"%s" % value
+    for char in u'|\r\n':
+        value = value.replace(char, u' ')
+    return value.strip().encode('iso-8859-15', 'replace')
+
+
+def _fec_amount(value):
+    return ('%.2f' % value).replace('.', ',')
+
+
+def _fec_decimal(value):
+    return str(value.quantize(Decimal('0.01'))).replace('.', ',')
+
+
+class FECWriter(ExportWriter):
+    """
+    The French FEC layout: the FEC_COLUMNS, ``|`` separated, dates as
+    YYYYMMDD, amounts with a decimal comma, encoded in ISO 8859-15.
+    """
+    extension = 'txt'
+    gather = 'gather_fec'
+    formatters = {
+        object: _fec_text,
+        type(None): lambda value: '',
+        Decimal: _fec_decimal,
+        float: _fec_amount,
+        date: lambda value: value.strftime('%Y%m%d'),
+    }
+
+    def __init__(self, fileobj):
+        super(FECWriter, self).__init__(fileobj)
+        self.write_fields(FEC_COLUMNS)
+
+    def write(self, row):
+        if len(row) != len(FEC_COLUMNS):
+            raise Exception(u"%s" % _(u"A FEC row has %(expected)d columns, "
+                                      u"not %(count)d") % {
+                'expected': len(FEC_COLUMNS), 'count': len(row)})
+        super(FECWriter, self).write(row)
+
+    def write_fields(self, fields):
+        self.fileobj.write('%s\r\n' % '|'.join(fields))
+
+
+_writers = {}
+
+
+def register_writer(name, writer_class):
+    """
+    Makes ``writer_class`` available as the export format ``name``.
+    """
+    _writers[name] = writer_class
+
+
+def get_writer(name=None):
+    """
+    :return: the writer class of the format ``name`` (INV_EXPORT_FORMAT by
+        default)
+    """
+    name = name or inv_settings.INV_EXPORT_FORMAT
+    try:
+        return _writers[name]
+    except KeyError:
+        raise Exception(u"%s" % _(u"Unknown export format: %s") % name)
+
+
+def writer_for_file(filename):
+    """
+    :return: the writer class which wrote ``filename``, from its extension
+    """
+    for writer_class in sorted(_writers.values(),
+                               key=lambda w: -len(w.extension)):
+        if filename.endswith('.' + writer_class.extension):
+            return writer_class
+    return get_writer()
+
+
+register_writer('csv', CSVWriter)
+register_writer('csv.gz', GzipCSVWriter)
+register_writer('jsonl', JSONLinesWriter)
+register_writer('fec', FECWriter)
 
 
 def utf_8_encoder(unicode_csv_data):
@@ -71,12 +528,15 @@ def utf_8_encoder(unicode_csv_data):
         yield line.encode('utf-8')
 
 
-def gather_data_and_update_flags(*args, **kwargs):
+def get_export_module():
     try:
-        data_module = importlib.import_module(inv_settings.INV_EXPORT_MODULE)
+        return importlib.import_module(inv_settings.INV_EXPORT_MODULE)
     except:
         logger.error(u"%s" % _(u"Export module not found! %s " %
                                inv_settings.INV_EXPORT_MODULE))
         raise Exception(u"%s" % _(u"Export module not found!"))
 
+
+def gather_data_and_update_flags(*args, **kwargs):
+    data_module = get_export_module()
     return data_module.gather_data_and_update_flags(*args, **kwargs)
@@ -1,12 +1,92 @@
-from .models import Invoice
+# -*- coding: utf-8 -*-
+from datetime import date
+from decimal import Decimal
 
+# Accounts of the FEC entries, from the French "plan comptable général"
+SALES_JOURNAL = ('VT', u'Ventes')
+BANK_JOURNAL = ('BQ', u'Banque')
+CUSTOMER_ACCOUNT = ('411000', u'Clients')
+SALES_ACCOUNT = ('706000', u'Prestations de services')
+BANK_ACCOUNT = ('512000', u'Banque')
+ZERO = Decimal('0.00')
 
-def gather_data_and_update_flags(test=True):
-    invoices = Invoice.objects.filter(is_exported__in=('invoice_only',
-                                                       'no'))
 
-    data = []
-    for invoice in invoices:
+def gather_data(invoices, payments):
+    """
+    Returns the rows of the export: the invoices (their items) and the
+    payments to export.
+
+    The invoices and payments are marked as exported by the export
+    itself, see ``Export.claim``.
+    """
+    invoices = invoices.only('invoice_date', 'invoice_id', 'subtotal')
+    # A generator: the rows are written as they are read
+    for invoice in invoices.chunked_iterator():
         # Dummy example, you have to impement it yourself ;)
-        data.append([invoice.invoice_date, invoice.total(), ])
-    return data
+        yield [invoice.invoice_date, invoice.invoice_id, invoice.total(), ]
+    for payment in payments.select_related('invoice').iterator():
+        yield [payment.paid_date, payment.invoice.invoice_id,
+               -payment.amount, ]
+
+
+def gather_delta(invoices, payments, since):
+    """
+    Returns the rows of a delta export: the invoices and payments modified
+    since the date ``since`` (None for the first delta export).
+
+    Each row starts with ``insert`` for the rows created since ``since``,
+    ``update`` for the others.
+    """
+    def operation(row):
+        if since is None or row.creation_date > since:
+            return 'insert'
+        return 'update'
+
+    invoices = invoices.only('invoice_date', 'invoice_id', 'subtotal',
+                             'creation_date')
+    for invoice in invoices.chunked_iterator():
+        yield [operation(invoice), invoice.invoice_date, invoice.invoice_id,
+               invoice.total(), ]
+    for payment in payments.select_related('invoice').iterator():
+        yield [operation(payment), payment.paid_date,
+               payment.invoice.invoice_id, -payment.amount, ]
+
+
+def gather_fec(invoices, payments):
+    """
+    Returns the rows of an export in the ``fec`` format: the accounting
+    entries of the invoices (the customer is debited, the sales credited)
+    and of the payments (the bank is debited, the customer credited), with
+    the columns of ``invoice.export.FEC_COLUMNS``.
+    """
+    valid_date = date.today()
+
+    def entry(journal, number, entry_date, account, invoice, label, amount):
+        # A negative amount (a credit note) goes to the other side
+        debit, credit = (amount, ZERO) if amount >= 0 else (ZERO, -amount)
+        if account == CUSTOMER_ACCOUNT:
+            auxiliary = (u'C%s' % invoice.recipient_id,
+                         u'%s' % invoice.recipient)
+        else:
+            auxiliary = (u'', u'')
+        return [journal[0], journal[1], number, entry_date, account[0],
+                account[1], auxiliary[0], auxiliary[1], invoice.invoice_id,
+                invoice.invoice_date, label, debit, credit, u'', None,
+                valid_date, None, u'']
+
+    invoices = invoices.select_related('recipient').only(
+        'invoice_date', 'invoice_id', 'subtotal', 'recipient')
+    for invoice in invoices.chunked_iterator():
+        label = u'Facture %s' % invoice.invoice_id
+        yield entry(SALES_JOURNAL, invoice.invoice_id, invoice.invoice_date,
+                    CUSTOMER_ACCOUNT, invoice, label, invoice.total())
+        yield entry(SALES_JOURNAL, invoice.invoice_id, invoice.invoice_date,
+                    SALES_ACCOUNT, invoice, label, -invoice.total())
+    for payment in payments.select_related('invoice__recipient').iterator():
+        invoice = payment.invoice
+        number = u'%s-%s' % (invoice.invoice_id, payment.pk)
+        label = u'Règlement %s' % invoice.invoice_id
+        yield entry(BANK_JOURNAL, number, payment.paid_date, BANK_ACCOUNT,
+                    invoice, label, payment.amount)
+        yield entry(BANK_JOURNAL, number, payment.paid_date,
+                    CUSTOMER_ACCOUNT, invoice, label, -payment.amount)
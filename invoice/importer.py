@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+from datetime import datetime
+from decimal import Decimal
+from itertools import groupby, islice
+from operator import itemgetter
+
+from django.db import models, reset_queries
+
+from .models import Invoice, Currency
+from .conf import settings as inv_settings
+
+INVOICE_COLUMNS = ('recipient', 'invoice_date', 'currency',
+                   'invoice_cost_code', 'draft')
+ITEM_COLUMNS = ('description', 'unit_price', 'quantity')
+
+
+def import_invoices(specs, chunk_size=None):
+    """
+    Creates invoices from an iterable of specs (see
+    ``InvoiceManager.bulk_create_invoices``), ``chunk_size`` invoices at a
+    time, so the memory used does not depend on the input size.
+
+    Values may be strings, as read from a file: ``recipient`` is then a pk,
+    ``currency`` a currency code and ``invoice_date`` a ``YYYY-MM-DD`` date.
+
+    :return: int (number of invoices created)
+    """
+    chunk_size = chunk_size or inv_settings.INV_IMPORT_CHUNK_SIZE
+    specs = iter(specs)
+    currencies = {}
+    count = 0
+    while True:
+        chunk = [clean_spec(spec, currencies)
+                 for spec in islice(specs, chunk_size)]
+        if not chunk:
+            break
+        Invoice.objects.bulk_create_invoices(chunk, batch_size=chunk_size)
+        count += len(chunk)
+        # With DEBUG = True, Django keeps every query
+        reset_queries()
+    return count
+
+
+def clean_spec(spec, currencies=None):
+    """
+    Converts the string values of an invoice spec to field values.
+    ``currencies`` caches the currency pks by code.
+    """
+    if currencies is None:
+        currencies = {}
+    spec = dict(spec)
+
+    recipient = spec.pop('recipient', None)
+    if isinstance(recipient, models.Model):
+        spec['recipient'] = recipient
+    elif recipient is not None:
+        spec['recipient_id'] = int(recipient)
+
+    currency = spec.get('currency')
+    if isinstance(currency, basestring):
+        del spec['currency']
+        if currency:
+            if currency not in currencies:
+                currencies[currency] = Currency.objects.get(code=currency).pk
+            spec['currency_id'] = currencies[currency]
+
+    invoice_date = spec.get('invoice_date')
+    if isinstance(invoice_date, basestring):
+        if invoice_date:
+            spec['invoice_date'] = datetime.strptime(invoice_date,
+                                                     '%Y-%m-%d').date()
+        else:
+            del spec['invoice_date']
+
+    if isinstance(spec.get('draft'), basestring):
+        spec['draft'] = spec['draft'].lower() in ('1', 'true', 'yes')
+
+    items = []
+    for item in spec.get('items', ()):
+        item = dict(item)
+        item['unit_price'] = Decimal(str(item['unit_price']))
+        if item.get('quantity') not in (None, ''):
+            item['quantity'] = Decimal(str(item['quantity']))
+        else:
+            item.pop('quantity', None)
+        items.append(item)
+    spec['items'] = items
+    return spec
+
+
+def read_csv(fileobj, delimiter=';'):
+    """
+    Reads invoice specs from a UTF-8 CSV file with one row per item. The
+    ``invoice`` column groups the consecutive rows of the same invoice, the
+    invoice columns are read from its first row.
+
+    ``invoice;recipient;invoice_date;currency;description;unit_price;quantity``
+    """
+    reader = csv.DictReader(fileobj, delimiter=delimiter)
+    for key, rows in groupby(reader, itemgetter('invoice')):
+        spec = None
+        for row in rows:
+            row = dict((column, value.decode('utf-8'))
+                       for column, value in row.items() if value)
+            if spec is None:
+                spec = dict((column, row[column])
+                            for column in INVOICE_COLUMNS if column in row)
+                spec['items'] = []
+            if row.get('description'):
+                spec['items'].append(dict((column, row[column])
+                                          for column in ITEM_COLUMNS
+                                          if column in row))
+        yield spec
+
+
+def read_json_lines(fileobj):
+    """
+    Reads invoice specs from a JSON Lines file, one invoice spec per line.
+    """
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line, parse_float=Decimal)
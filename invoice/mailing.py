@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+from email.encoders import encode_noop
+from email.mime.application import MIMEApplication
+from email.MIMEImage import MIMEImage
+from itertools import count
+from multiprocessing import Pool
+from os import stat
+from os.path import join
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection as db_connection
+from django.template.loader import get_template
+from django.template import Context
+
+from .conf import settings as inv_settings
+from . import pdf_cache
+from .utils.buffers import SpooledBuffer
+
+# Compiled e-mail templates, by template name
+_templates = {}
+# MIME parts of the inline images and their last use, by
+# (path, mtime, content ID)
+_images = {}
+_clock = count()
+
+
+def get_email_templates(template):
+    """
+    :return: tuple (text template, HTML template), compiled once per process
+        (unless DEBUG is on)
+    """
+    templates = _templates.get(template)
+    if templates is None:
+        templates = (get_template('invoice/email/%s.txt' % template),
+                     get_template('invoice/email/%s.html' % template))
+        if not settings.DEBUG:
+            _templates[template] = templates
+    return templates
+
+
+def get_inline_image(path, content_id):
+    """
+    Returns the MIME part of the image ``path``, read once as long as the
+    file does not change. The part is shared by the messages, it must not be
+    modified.
+    """
+    key = (path, stat(path).st_mtime, content_id)
+    if key in _images:
+        image = _images[key][1]
+    else:
+        with open(path, 'rb') as fp:
+            image = MIMEImage(fp.read())
+        image.add_header('Content-ID', '<' + content_id + '>')
+    _images[key] = (next(_clock), image)
+    if len(_images) > inv_settings.INV_EMAIL_IMAGE_CACHE_SIZE:
+        # Drop the least recently used image
+        del _images[min(_images, key=lambda k: _images[k][0])]
+    return image
+
+
+class PDFAttachment(MIMEApplication):
+    """
+    MIME part of a PDF held by a SpooledBuffer, encoded by blocks only when
+    the message is written out: the messages waiting in a batch keep their
+    PDF in the buffer (on disk when large) rather than in memory.
+    """
+    def __init__(self, pdf):
+        MIMEApplication.__init__(self, '', _encoder=encode_noop)
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.pdf = pdf
+
+    def get_payload(self, i=None, decode=False):
+        if decode:
+            return self.pdf.getvalue()
+        return self.pdf.base64()
+
+
+def close_attachments(email):
+    """
+    Closes the SpooledBuffers of the PDF attachments of ``email``, once sent.
+    """
+    for attachment in email.attachments:
+        if isinstance(attachment, PDFAttachment):
+            attachment.pdf.close()
+
+
+def build_invoice_email(invoice, to_email=None, subject=None,
+                        template='invoice_email', images=(), pdf=None,
+                        connection=None):
+    """
+    Builds the e-mail sending ``invoice`` with its PDF attached. ``pdf`` is
+    the PDF content (string or SpooledBuffer), it is taken from the PDF cache
+    when not given.
+
+    :return: EmailMultiAlternatives, or None if the invoice has no
+        recipient e-mail or its PDF cannot be drawn
+    """
+    if not (invoice.recipient.email or to_email):
+        return None
+    if pdf is None:
+        pdf = pdf_cache.get_pdf_buffer(invoice)
+        if pdf is None:
+            return None
+
+    if isinstance(pdf, SpooledBuffer):
+        attachment = PDFAttachment(pdf)
+    else:
+        attachment = MIMEApplication(pdf)
+    attachment.add_header("Content-Disposition", "attachment",
+                          filename=invoice.file_name())
+
+    if not to_email:
+        to_email = invoice.recipient.email
+    if not subject:
+        subject = inv_settings.INV_EMAIL_SUBJECT %\
+            {"invoice_id": invoice.invoice_id}
+
+    text_tmpl, html_tmpl = get_email_templates(template)
+
+    email_context = Context({
+        'invoice': invoice,
+        'date': date.today(),
+        "SITE_NAME": settings.SITE_NAME,
+        "INV_CURRENCY": inv_settings.INV_CURRENCY,
+        "INV_CURRENCY_SYMBOL": inv_settings.INV_CURRENCY_SYMBOL, })
+
+    text_content = text_tmpl.render(email_context)
+    html_content = html_tmpl.render(email_context)
+
+    email = EmailMultiAlternatives(subject=subject, body=text_content,
+                                   to=[to_email], connection=connection)
+    email.attach_alternative(html_content, "text/html")
+    email.attach(attachment)
+
+    for img in images:
+        email.attach(get_inline_image(join(settings.STATIC_ROOT, img[0]),
+                                      img[1]))
+
+    return email
+
+
+def send_invoices(invoices, chunk_size=None, processes=None,
+                  connection=None, **kwargs):
+    """
+    Sends ``invoices`` by e-mail through one mail connection, in chunks of
+    ``chunk_size`` (default: ``INV_EMAIL_BATCH_SIZE``) invoices. The messages
+    are sent one by one and the invoices delivered in a chunk are marked as
+    invoiced with one UPDATE, also when sending fails midway.
+
+    With ``processes`` (default: ``INV_EMAIL_PROCESSES``) greater than 1,
+    a pool of processes renders the PDFs of the next chunk while the current
+    one is being sent. Other keyword arguments are passed to
+    ``build_invoice_email``.
+
+    :return: int (number of invoices sent)
+    """
+    from .models import Invoice
+
+    chunk_size = chunk_size or inv_settings.INV_EMAIL_BATCH_SIZE
+    processes = processes or inv_settings.INV_EMAIL_PROCESSES
+    pks = list(invoices.values_list('pk', flat=True))
+    chunks = [pks[start:start + chunk_size]
+              for start in range(0, len(pks), chunk_size)]
+    if not chunks:
+        return 0
+
+    pool = None
+    if processes > 1:
+        # The forked workers must not share the parent's connection
+        db_connection.close()
+        pool = Pool(processes)
+
+    def render(chunk):
+        if pool is None:
+            return None
+        return pool.map_async(render_pdf, chunk)
+
+    connection = connection or get_connection()
+    opened = connection.open()
+    sent = 0
+    try:
+        pending = render(chunks[0])
+        for index, chunk in enumerate(chunks):
+            if pending is None:
+                pdfs = [None] * len(chunk)
+            else:
+                pdfs = pending.get()
+            if index + 1 < len(chunks):
+                pending = render(chunks[index + 1])
+
+            by_pk = Invoice.objects.select_related('recipient', 'currency')\
+                .in_bulk(chunk)
+            sent_pks = []
+            emails = []
+            try:
+                for pk, pdf in zip(chunk, pdfs):
+                    invoice = by_pk.get(pk)
+                    if invoice is None:
+                        continue
+                    email = build_invoice_email(invoice, pdf=pdf,
+                                                connection=connection,
+                                                **kwargs)
+                    if email is not None:
+                        emails.append(email)
+                    # send_messages() returns 0 when a fail_silently
+                    # connection could not send the message
+                    if email is not None and connection.send_messages([email]):
+                        sent_pks.append(pk)
+            finally:
+                if sent_pks:
+                    Invoice.objects.filter(pk__in=sent_pks)\
+                        .update(invoiced=True)
+                    sent += len(sent_pks)
+                for email in emails:
+                    close_attachments(email)
+    finally:
+        if opened:
+            connection.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return sent
+
+
+def render_pdf(pk):
+    """
+    Pool task: returns the PDF of the invoice ``pk``, or None if it does not
+    exist any more.
+    """
+    from .models import Invoice
+
+    try:
+        invoice = Invoice.objects.select_related('recipient', 'currency')\
+            .get(pk=pk)
+    except Invoice.DoesNotExist:
+        # Deleted since the chunks were read, send_invoices() skips it
+        return None
+    return pdf_cache.get_pdf(invoice)
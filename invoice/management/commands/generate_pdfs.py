@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...models import Invoice
+from ...pdf_batch import generate_pdfs
+
+
+class Command(BaseCommand):
+    args = '[invoice_id invoice_id ...]'
+    help = 'Generate the invoice PDFs (all invoices by default)'
+    option_list = BaseCommand.option_list + (
+        make_option('--missing', action='store_true', dest='missing',
+                    default=False,
+                    help='Only generate the PDFs which do not exist yet'),
+        make_option('--processes', dest='processes', type='int',
+                    default=None,
+                    help='Number of worker processes (default: CPU count)'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=None,
+                    help='Number of invoices rendered per task'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options['verbosity'])
+        invoices = Invoice.objects.all()
+        if args:
+            invoices = invoices.filter(invoice_id__in=args)
+
+        report = generate_pdfs(invoices,
+                               processes=options['processes'],
+                               chunk_size=options['chunk_size'],
+                               missing=options['missing'],
+                               progress=self.progress)
+        self.stdout.write(unicode(report))
+        if report.failed:
+            self.stderr.write(u"Failed invoice pks: %s" % u", ".join(
+                [unicode(pk) for pk in report.failed]))
+
+    def progress(self, report):
+        if self.verbosity > 1:
+            self.stdout.write(unicode(report))
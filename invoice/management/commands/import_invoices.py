@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...importer import import_invoices, read_csv, read_json_lines
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_json_lines,
+}
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Import invoices and their items from a CSV or JSON Lines file'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help='csv or jsonl (default: guessed from the file '
+                         'extension)'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=None,
+                    help='Number of invoices inserted at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_invoices %s' % self.args)
+        path = args[0]
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if fmt not in READERS:
+            raise CommandError('Unknown format "%s", use one of: %s' % (
+                fmt, ', '.join(sorted(READERS))))
+
+        with open(path, 'rb') as fileobj:
+            count = import_invoices(READERS[fmt](fileobj),
+                                    chunk_size=options['chunk_size'])
+        self.stdout.write(u"%d invoice(s) imported" % count)
@@ -0,0 +1,74 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+
+from ...models import Invoice
+from ...benchmarks import BENCHMARKS, make_fixture
+
+
+class Command(BaseCommand):
+    args = '<name name ...>'
+    help = 'Run benchmarks (all of them by default): %s' % ', '.join(
+        sorted(BENCHMARKS))
+    option_list = BaseCommand.option_list + (
+        make_option('--fixture', dest='fixture', type='int', default=None,
+                    help='Run in a new test database filled with this '
+                         'number of fixture invoices (e.g. 1000000), '
+                         'destroyed afterwards'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Destroy an old test database without asking'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='Runs of each measure, the best one is reported'),
+    )
+
+    def handle(self, *args, **options):
+        names = args or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError(u"Unknown benchmark: %s" % name)
+
+        if not options['fixture']:
+            self.run_benchmarks(names, options['repeat'])
+            return
+
+        # The fixture invoices would be due, exported, sent... they never
+        # go to the real database
+        verbosity = int(options['verbosity'])
+        try:
+            from south.management.commands import patch_for_test_db_setup
+        except ImportError:
+            pass
+        else:
+            patch_for_test_db_setup()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity, autoclobber=not options['interactive'])
+        try:
+            created = make_fixture(options['fixture'], self.make_recipient())
+            self.stdout.write(u"%d fixture invoice(s) created" % created)
+            self.run_benchmarks(names, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+
+    def run_benchmarks(self, names, repeat):
+        for name in names:
+            self.stdout.write(u"== %s" % name)
+            BENCHMARKS[name](self.stdout.write, repeat=repeat)
+
+    def make_recipient(self):
+        """
+        :return: a new recipient for the fixture invoices
+        """
+        recipient_model = Invoice._meta.get_field('recipient').rel.to
+        fields = {}
+        username_field = getattr(recipient_model, 'USERNAME_FIELD', None)
+        if username_field:
+            fields[username_field] = 'benchmark'
+        try:
+            return recipient_model.objects.create(**fields)
+        except DatabaseError, e:
+            raise CommandError(u"Cannot create a %s for the fixture "
+                               u"invoices: %s" %
+                               (recipient_model._meta.object_name, e))
@@ -0,0 +1,62 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Invoice
+from ...print_run import write_print_run, VOLUME_SIZE
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(u"Invalid date: %s (YYYY-MM-DD)" % value)
+
+
+class Command(BaseCommand):
+    args = '<output> [invoice_id invoice_id ...]'
+    help = ('Write the invoices which are not drafts (all of them by '
+            'default) to one PDF, in volumes, or to a ZIP of their PDFs')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='pdf',
+                    choices=('pdf', 'zip'),
+                    help='pdf (merged, default) or zip (one PDF per invoice)'),
+        make_option('--volume-size', dest='volume_size', type='int',
+                    default=VOLUME_SIZE,
+                    help='Invoices per merged PDF, the files are suffixed '
+                         'with -001, -002... (default: %d, 0 for one PDF)' %
+                         VOLUME_SIZE),
+        make_option('--from', dest='date_from', default=None,
+                    help='Only the invoices of this date (YYYY-MM-DD) or '
+                         'after'),
+        make_option('--to', dest='date_to', default=None,
+                    help='Only the invoices of this date (YYYY-MM-DD) or '
+                         'before'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError(u"Give the output file")
+        self.verbosity = int(options['verbosity'])
+        output, invoice_ids = args[0], args[1:]
+
+        invoices = Invoice.objects.filter(draft=False)
+        if invoice_ids:
+            invoices = invoices.filter(invoice_id__in=invoice_ids)
+        if options['date_from']:
+            invoices = invoices.filter(
+                invoice_date__gte=parse_date(options['date_from']))
+        if options['date_to']:
+            invoices = invoices.filter(
+                invoice_date__lte=parse_date(options['date_to']))
+
+        paths = write_print_run(invoices, output, format=options['format'],
+                                volume_size=options['volume_size'],
+                                progress=self.progress)
+        for path in paths:
+            self.stdout.write(path)
+
+    def progress(self, count):
+        if self.verbosity > 1 and not count % 100:
+            self.stdout.write(u"%d invoice(s)" % count)
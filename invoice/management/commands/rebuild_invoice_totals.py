@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...models import Invoice
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or verify) the stored invoice totals'
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+                    default=False,
+                    help='Only report the invoices with wrong totals'),
+    )
+
+    def handle(self, *args, **options):
+        check = options['check']
+        mismatches = 0
+        for invoice in Invoice.objects.order_by('pk').iterator():
+            subtotal, paid_total = invoice.compute_totals()
+            if (subtotal, paid_total) == (invoice.subtotal,
+                                          invoice.paid_total):
+                continue
+            mismatches += 1
+            self.stdout.write(u"%s: stored %s / %s, computed %s / %s" % (
+                invoice.invoice_id, invoice.subtotal, invoice.paid_total,
+                subtotal, paid_total))
+            if not check:
+                invoice.subtotal, invoice.paid_total = subtotal, paid_total
+                # The new modification date takes the fixed totals to the
+                # next delta export
+                Invoice.objects.filter(pk=invoice.pk).update(
+                    subtotal=subtotal, paid_total=paid_total,
+                    is_paid=invoice._compute_is_paid(),
+                    modification_date=timezone.now())
+                if invoice.is_credit_note and invoice.invoice_related_id:
+                    related = invoice.invoice_related
+                    is_paid = related._compute_is_paid()
+                    if is_paid != related.is_paid:
+                        Invoice.objects.filter(pk=related.pk).update(
+                            is_paid=is_paid,
+                            modification_date=timezone.now())
+
+        if check and mismatches:
+            raise CommandError(u"%d invoice(s) with wrong totals" % mismatches)
+        self.stdout.write(u"%d invoice(s) %s" % (
+            mismatches, 'to fix' if check else 'fixed'))
@@ -0,0 +1,44 @@
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from ...export import claim_next_export, run_export, queue_export
+
+
+class Command(BaseCommand):
+    help = 'Run the pending accounting exports'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit when there is no pending export left'),
+        make_option('--queue', dest='queue', default=None,
+                    choices=('flags', 'delta'),
+                    help='Queue an export first: "flags" for the rows not '
+                         'exported yet, "delta" for the changes since the '
+                         'last delta export'),
+        make_option('--sleep', dest='sleep', type='float', default=5,
+                    help='Seconds between two checks for pending exports '
+                         '(default: 5)'),
+    )
+
+    def handle(self, *args, **options):
+        self.verbosity = int(options['verbosity'])
+        if options['queue']:
+            queue_export(options['queue'])
+        while True:
+            export = claim_next_export()
+            if export is None:
+                if options['once']:
+                    return
+                sleep(options['sleep'])
+                continue
+
+            run_export(export)
+            if export.status == 'failed':
+                self.stderr.write(u"Export %s failed: %s" % (export.pk,
+                                                             export.error))
+            elif self.verbosity > 0:
+                self.stdout.write(u"Export %s done: %s rows (%.0f rows/s)" % (
+                    export.pk, export.rows_done,
+                    export.rows_per_second or 0))
@@ -1,9 +1,47 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
-from ...utils import send_invoices
+
+from ...dispatch import run_send_job
 
 
 class Command(BaseCommand):
-    help = 'Send due invoices'
+    help = 'Send due invoices (resumes the last unfinished run, if any)'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=None,
+                    help='Number of invoices fetched at a time'),
+        make_option('--rate', dest='rate', type='float', default=None,
+                    help='Maximum number of e-mails sent per second'),
+        make_option('--concurrency', dest='concurrency', type='int',
+                    default=None,
+                    help='Number of e-mails sent at the same time'),
+        make_option('--max-tries', dest='max_tries', type='int',
+                    default=None,
+                    help='Number of tries before giving up an e-mail'),
+        make_option('--retry-delay', dest='retry_delay', type='int',
+                    default=None,
+                    help='Seconds before the first retry, doubled for each '
+                         'next one'),
+    )
 
     def handle(self, *args, **options):
-        send_invoices()
+        self.verbosity = int(options['verbosity'])
+        job = run_send_job(chunk_size=options['chunk_size'],
+                           rate=options['rate'],
+                           concurrency=options['concurrency'],
+                           max_tries=options['max_tries'],
+                           retry_delay=options['retry_delay'],
+                           progress=self.progress)
+        self.stdout.write(u"%d invoice(s) sent, %d failed" % (
+            job.sent_count, job.failed_count))
+        unknown = job.attempts.filter(status='unknown').count()
+        if unknown:
+            self.stderr.write(u"%d invoice(s) may have been sent before an "
+                              u"interruption, check them (send attempts "
+                              u"in the 'unknown' state)" % unknown)
+
+    def progress(self, job):
+        if self.verbosity > 1:
+            self.stdout.write(u"%d invoice(s) sent, %d failed" % (
+                job.sent_count, job.failed_count))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+from django.conf import settings as app_settings
+app_model_label = '%s' % app_settings.INV_CLIENT_MODULE
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Invoice.subtotal'
+        db.add_column(u'invoice_invoice', 'subtotal',
+                      self.gf('django.db.models.fields.DecimalField')(default='0.00', max_digits=12, decimal_places=2),
+                      keep_default=False)
+
+        # Adding field 'Invoice.paid_total'
+        db.add_column(u'invoice_invoice', 'paid_total',
+                      self.gf('django.db.models.fields.DecimalField')(default='0.00', max_digits=12, decimal_places=2),
+                      keep_default=False)
+
+        # Fill the new columns from the existing items and payments, in
+        # Decimal with the rounding of invoice.models.line_total() (half to
+        # even): the SQL ROUND() rounds half away from zero, and computes
+        # with floats on SQLite. Run the rebuild_invoice_totals command to
+        # check the result.
+        if not db.dry_run:
+            totals = {}
+            items = orm['invoice.InvoiceItem'].objects.values_list(
+                'invoice_id', 'unit_price', 'quantity')
+            for invoice_id, unit_price, quantity in items.iterator():
+                line = Decimal(str(unit_price * quantity)).quantize(
+                    Decimal('0.01'))
+                totals.setdefault(invoice_id, [Decimal('0.00'),
+                                               Decimal('0.00')])[0] += line
+            payments = orm['invoice.InvoicePayment'].objects.values_list(
+                'invoice_id', 'amount')
+            for invoice_id, amount in payments.iterator():
+                totals.setdefault(invoice_id, [Decimal('0.00'),
+                                               Decimal('0.00')])[1] += amount
+            for invoice_id, (subtotal, paid_total) in totals.iteritems():
+                orm['invoice.Invoice'].objects.filter(pk=invoice_id).update(
+                    subtotal=subtotal, paid_total=paid_total)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Invoice.subtotal'
+        db.delete_column(u'invoice_invoice', 'subtotal')
+
+        # Deleting field 'Invoice.paid_total'
+        db.delete_column(u'invoice_invoice', 'paid_total')
+
+
+    models = {
+        app_model_label: app_settings.INV_MODEL_LABEL,
+        u'invoice.currency': {
+            'Meta': {'object_name': 'Currency'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '3'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'post_symbol': ('django.db.models.fields.CharField', [], {'max_length': '1', 'blank': 'True'}),
+            'pre_symbol': ('django.db.models.fields.CharField', [], {'max_length': '1', 'blank': 'True'})
+        },
+        u'invoice.export': {
+            'Meta': {'object_name': 'Export'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'date': ('django.db.models.fields.DateField', [], {}),
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'invoice.invoice': {
+            'Meta': {'ordering': "('-invoice_date', 'id')", 'object_name': 'Invoice'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'currency': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['invoice.Currency']", 'null': 'True', 'blank': 'True'}),
+            'draft': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice_cost_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'}),
+            'invoice_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today'}),
+            'invoice_id': ('django.db.models.fields.CharField', [], {'max_length': '10', 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'invoice_related': ('django.db.models.fields.related.OneToOneField', [], {'blank': 'True', 'related_name': "'credit_note'", 'unique': 'True', 'null': 'True', 'to': u"orm['invoice.Invoice']"}),
+            'invoiced': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_credit_note': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_exported': ('django.db.models.fields.CharField', [], {'default': "'no'", 'max_length': '20'}),
+            'is_paid': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'paid_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '12', 'decimal_places': '2'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'}),
+            'number': ('django.db.models.fields.IntegerField', [], {'db_index': 'True', 'blank': 'True'}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['%s']" % app_settings.INV_CLIENT_MODULE}),
+            'subtotal': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '12', 'decimal_places': '2'})
+        },
+        u'invoice.invoiceitem': {
+            'Meta': {'object_name': 'InvoiceItem'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': u"orm['invoice.Invoice']"}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'quantity': ('django.db.models.fields.DecimalField', [], {'default': '1', 'max_digits': '8', 'decimal_places': '2'}),
+            'unit_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '8', 'decimal_places': '2'})
+        },
+        u'invoice.invoicepayment': {
+            'Meta': {'object_name': 'InvoicePayment'},
+            'additional_info': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '8', 'decimal_places': '2'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'payments'", 'to': u"orm['invoice.Invoice']"}),
+            'is_exported': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'paid_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.datetime(2014, 2, 27, 0, 0)'})
+        }
+    }
+
+    complete_apps = ['invoice']
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+from django.conf import settings as app_settings
+app_model_label = '%s' % app_settings.INV_CLIENT_MODULE
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'SendJob'
+        db.create_table(u'invoice_sendjob', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('status', self.gf('django.db.models.fields.CharField')(default='running', max_length=20)),
+            ('last_invoice', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('sent_count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('failed_count', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('finish_date', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('creation_date', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('modification_date', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+        ))
+        db.send_create_signal(u'invoice', ['SendJob'])
+
+        # Adding model 'SendAttempt'
+        db.create_table(u'invoice_sendattempt', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('job', self.gf('django.db.models.fields.related.ForeignKey')(related_name='attempts', to=orm['invoice.SendJob'])),
+            ('invoice', self.gf('django.db.models.fields.related.ForeignKey')(related_name='send_attempts', to=orm['invoice.Invoice'])),
+            ('status', self.gf('django.db.models.fields.CharField')(default='queued', max_length=20)),
+            ('tries', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('error', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('next_try', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+            ('creation_date', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('modification_date', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+        ))
+        db.send_create_signal(u'invoice', ['SendAttempt'])
+
+        # Adding unique constraint on 'SendAttempt', fields ['job', 'invoice']
+        db.create_unique(u'invoice_sendattempt', ['job_id', 'invoice_id'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'SendAttempt', fields ['job', 'invoice']
+        db.delete_unique(u'invoice_sendattempt', ['job_id', 'invoice_id'])
+
+        # Deleting model 'SendAttempt'
+        db.delete_table(u'invoice_sendattempt')
+
+        # Deleting model 'SendJob'
+        db.delete_table(u'invoice_sendjob')
+
+
+    models = {
+        app_model_label: app_settings.INV_MODEL_LABEL,
+        u'invoice.currency': {
+            'Meta': {'object_name': 'Currency'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '3'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'post_symbol': ('django.db.models.fields.CharField', [], {'max_length': '1', 'blank': 'True'}),
+            'pre_symbol': ('django.db.models.fields.CharField', [], {'max_length': '1', 'blank': 'True'})
+        },
+        u'invoice.export': {
+            'Meta': {'object_name': 'Export'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'date': ('django.db.models.fields.DateField', [], {}),
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'invoice.invoice': {
+            'Meta': {'ordering': "('-invoice_date', 'id')", 'object_name': 'Invoice'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'currency': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['invoice.Currency']", 'null': 'True', 'blank': 'True'}),
+            'draft': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice_cost_code': ('django.db.models.fields.CharField', [], {'max_length': '10', 'null': 'True', 'blank': 'True'}),
+            'invoice_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.date.today'}),
+            'invoice_id': ('django.db.models.fields.CharField', [], {'max_length': '10', 'unique': 'True', 'null': 'True', 'blank': 'True'}),
+            'invoice_related': ('django.db.models.fields.related.OneToOneField', [], {'blank': 'True', 'related_name': "'credit_note'", 'unique': 'True', 'null': 'True', 'to': u"orm['invoice.Invoice']"}),
+            'invoiced': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_credit_note': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_exported': ('django.db.models.fields.CharField', [], {'default': "'no'", 'max_length': '20'}),
+            'is_paid': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'paid_total': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '12', 'decimal_places': '2'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'modified': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'}),
+            'number': ('django.db.models.fields.IntegerField', [], {'db_index': 'True', 'blank': 'True'}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['%s']" % app_settings.INV_CLIENT_MODULE}),
+            'subtotal': ('django.db.models.fields.DecimalField', [], {'default': "'0.00'", 'max_digits': '12', 'decimal_places': '2'})
+        },
+        u'invoice.invoiceitem': {
+            'Meta': {'object_name': 'InvoiceItem'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'items'", 'to': u"orm['invoice.Invoice']"}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'quantity': ('django.db.models.fields.DecimalField', [], {'default': '1', 'max_digits': '8', 'decimal_places': '2'}),
+            'unit_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '8', 'decimal_places': '2'})
+        },
+        u'invoice.invoicepayment': {
+            'Meta': {'object_name': 'InvoicePayment'},
+            'additional_info': ('django.db.models.fields.CharField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '8', 'decimal_places': '2'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'payments'", 'to': u"orm['invoice.Invoice']"}),
+            'is_exported': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'paid_date': ('django.db.models.fields.DateField', [], {'default': 'datetime.datetime(2014, 2, 27, 0, 0)'})
+        },
+        u'invoice.invoicesequence': {
+            'Meta': {'object_name': 'InvoiceSequence'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_number': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'year': ('django.db.models.fields.IntegerField', [], {'unique': 'True'})
+        },
+        u'invoice.sendattempt': {
+            'Meta': {'unique_together': "(('job', 'invoice'),)", 'object_name': 'SendAttempt'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'send_attempts'", 'to': u"orm['invoice.Invoice']"}),
+            'job': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'attempts'", 'to': u"orm['invoice.SendJob']"}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'next_try': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'queued'", 'max_length': '20'}),
+            'tries': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        u'invoice.sendjob': {
+            'Meta': {'ordering': "('-id',)", 'object_name': 'SendJob'},
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'failed_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'finish_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_invoice': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'sent_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'running'", 'max_length': '20'})
+        }
+    }
+
+    complete_apps = ['invoice']
@@ -1,18 +1,14 @@
 # -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
 from datetime import date
 from decimal import Decimal
-from StringIO import StringIO
-from email.mime.application import MIMEApplication
-from email.MIMEImage import MIMEImage
 from os.path import join, isfile
 
-from django.db import models
-from django.db.models import Max
+from django.db import models, connection, IntegrityError
+from django.db.models import Max, Sum, F
 from django.conf import settings
 from django_extensions.db.models import TimeStampedModel
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import get_template
-from django.template import Context
 from django.utils.translation import ugettext_lazy as _
 from django.core import urlresolvers
 from django.db.models.signals import post_delete, post_save
@@ -21,10 +17,20 @@ try:
     from django.utils import importlib
 except ImportError:
     import importlib
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 
 from .utils import format_currency
 from .conf import settings as app_settings
-from .pdf import draw_pdf
+from .pdf import write_pdf
+from . import pdf_cache
+from .mailing import build_invoice_email
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class Currency(models.Model):
@@ -40,7 +46,87 @@ class Currency(models.Model):
         verbose_name_plural = _(u"currencies")
 
 
-class InvoiceManager(models.Manager):
+# Stay under the SQLite limit of 999 query parameters
+BULK_LOOKUP_SIZE = 500
+
+
+class InvoiceSequenceManager(models.Manager):
+    # The row of this "year" numbers all invoices. It stands in for the pk
+    # when the invoice ID is computed before the invoice is inserted.
+    SERIAL = 0
+
+    def reserve(self, year, count=1):
+        """
+        Reserves ``count`` consecutive invoice numbers for ``year``.
+
+        The counter row stays locked until the current transaction ends, so
+        concurrent workers never get the same numbers.
+
+        :return: int (the first reserved number)
+        """
+        with atomic():
+            if not self._increment(year, count):
+                self._create_sequence(year)
+                self._increment(year, count)
+            last_number = self.filter(year=year).values_list(
+                'last_number', flat=True)[0]
+        return last_number - count + 1
+
+    def reserve_serial(self, count=1):
+        return self.reserve(self.SERIAL, count)
+
+    def ensure(self, year, invoices=None):
+        """
+        Creates the counter of ``year`` if it does not exist yet, starting
+        after the numbers (or the pks for the serials) of ``invoices``
+        (default: all the invoices).
+        """
+        if not self.filter(year=year).exists():
+            self._create_sequence(year, invoices)
+
+    def has_serials(self):
+        """
+        :return: bool (False until the first serial number is reserved)
+        """
+        return self.filter(year=self.SERIAL).exists()
+
+    def _increment(self, year, count):
+        return self.filter(year=year).update(
+            last_number=F('last_number') + count)
+
+    def _create_sequence(self, year, invoices=None):
+        # Start after the invoices created before the sequence existed
+        if invoices is None:
+            invoices = Invoice.objects.all()
+        if year == self.SERIAL:
+            last_number = invoices.aggregate(Max('id'))['id__max']
+        else:
+            last_number = invoices.filter(
+                invoice_date__year=year).aggregate(
+                Max('number'))['number__max']
+        try:
+            with atomic():
+                self.create(year=year, last_number=last_number or 0)
+        except IntegrityError:
+            # Created by a concurrent worker
+            pass
+
+
+class InvoiceSequence(models.Model):
+    year = models.IntegerField(_(u"year"), unique=True)
+    last_number = models.IntegerField(_(u"last number"), default=0)
+
+    objects = InvoiceSequenceManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.year, self.last_number)
+
+    class Meta:
+        verbose_name = _(u"invoice sequence")
+        verbose_name_plural = _(u"invoice sequences")
+
+
+class InvoiceQuerySet(models.query.QuerySet):
     def get_invoiced(self):
         return self.filter(invoiced=True, draft=False)
 
@@ -49,6 +135,136 @@ class InvoiceManager(models.Manager):
                            invoiced=False,
                            draft=False)
 
+    def with_payments(self):
+        """
+        Annotates each invoice with ``paid_sum``, the sum of its payments,
+        computed by the database in the same query.
+        """
+        return self.extra(select={'paid_sum': _payments_total_sql()})
+
+    def chunked_iterator(self, chunk_size=1000):
+        """
+        Iterates over the invoices in pk order, fetching ``chunk_size`` rows
+        per query (seeking after the last pk, not with OFFSET), so only one
+        chunk is in memory whatever the database driver.
+        """
+        queryset = self.order_by('pk')
+        last_pk = None
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            for invoice in chunk:
+                yield invoice
+            last_pk = chunk[-1].pk
+
+    def seek(self, invoice_date=None, pk=None):
+        """
+        The invoices after the invoice (``invoice_date``, ``pk``) in the
+        default ordering, ``('-invoice_date', 'id')``: a page is
+        ``seek(*last_key)[:size]``, read from the index on
+        ``(invoice_date DESC, id)`` whatever its position, unlike OFFSET.
+        """
+        queryset = self.order_by('-invoice_date', 'id')
+        if invoice_date is None:
+            return queryset
+        return queryset.filter(
+            models.Q(invoice_date__lt=invoice_date) |
+            models.Q(invoice_date=invoice_date, pk__gt=pk))
+
+
+class InvoiceManager(models.Manager):
+    def get_queryset(self):
+        return InvoiceQuerySet(self.model, using=self._db)
+    # Django < 1.6
+    get_query_set = get_queryset
+
+    def get_invoiced(self):
+        return self.get_queryset().get_invoiced()
+
+    def get_due(self):
+        return self.get_queryset().get_due()
+
+    def with_payments(self):
+        return self.get_queryset().with_payments()
+
+    def seek(self, invoice_date=None, pk=None):
+        return self.get_queryset().seek(invoice_date, pk)
+
+    def bulk_create_invoices(self, specs, batch_size=None):
+        """
+        Creates invoices with their items using INSERTs of ``batch_size``
+        rows (default: ``INV_IMPORT_CHUNK_SIZE``), the invoices then the
+        items. Signals are not sent.
+
+        Each spec is a dict of ``Invoice`` field values plus an ``items``
+        list of dicts of ``InvoiceItem`` field values::
+
+            Invoice.objects.bulk_create_invoices([
+                {'recipient': user, 'items': [
+                    {'description': u'Hosting', 'unit_price': Decimal('9.90')},
+                ]},
+            ])
+
+        :return: list of the created invoices
+        """
+        invoices = []
+        item_specs = []
+        for spec in specs:
+            spec = dict(spec)
+            item_specs.append(spec.pop('items', ()))
+            invoices.append(self.model(**spec))
+        if not invoices:
+            return invoices
+        batch_size = batch_size or app_settings.INV_IMPORT_CHUNK_SIZE
+
+        with atomic():
+            by_year = {}
+            for invoice in invoices:
+                by_year.setdefault(invoice.invoice_date.year,
+                                   []).append(invoice)
+            for year, group in by_year.items():
+                first = InvoiceSequence.objects.reserve(year, len(group))
+                for offset, invoice in enumerate(group):
+                    invoice.number = first + offset
+
+            inv_id_module = importlib.import_module(app_settings.INV_ID_MODULE)
+            serial = InvoiceSequence.objects.reserve_serial(len(invoices))
+            serials = range(serial, serial + len(invoices))
+            numbers = [invoice.number for invoice in invoices]
+            if hasattr(inv_id_module, 'encode_many'):
+                invoice_ids = inv_id_module.encode_many(serials, numbers)
+            else:
+                invoice_ids = map(inv_id_module.encode, serials, numbers)
+            for invoice, invoice_id, items in zip(invoices, invoice_ids,
+                                                  item_specs):
+                invoice.invoice_id = invoice_id
+                invoice.subtotal = sum(
+                    [line_total(item['unit_price'], item.get('quantity', 1))
+                     for item in items], Decimal('0.00'))
+                invoice.is_paid = invoice._compute_is_paid()
+            self.bulk_create(invoices, batch_size=batch_size)
+
+            # bulk_create() does not set the pk on every backend
+            pks = {}
+            for start in range(0, len(invoices), BULK_LOOKUP_SIZE):
+                ids = [invoice.invoice_id
+                       for invoice in invoices[start:start + BULK_LOOKUP_SIZE]]
+                pks.update(self.filter(invoice_id__in=ids).values_list(
+                    'invoice_id', 'pk'))
+            invoice_items = []
+            for invoice, items in zip(invoices, item_specs):
+                invoice.pk = pks[invoice.invoice_id]
+                for item in items:
+                    invoice_items.append(InvoiceItem(invoice=invoice, **item))
+            InvoiceItem.objects.bulk_create(invoice_items,
+                                            batch_size=batch_size)
+
+        return invoices
+
 
 class Invoice(TimeStampedModel):
     EXPORTED_CHOICES = (
@@ -73,8 +289,9 @@ class Invoice(TimeStampedModel):
 
     creation_date = models.DateTimeField(_(u"date of creation"),
                                          auto_now_add=True)
+    # Indexed for the delta exports
     modification_date = models.DateTimeField(_(u"date of modification"),
-                                             auto_now=True)
+                                             auto_now=True, db_index=True)
     # Updated when the invoice is created
     is_credit_note = models.BooleanField(_(u"Is credit note"), default=False,
                                          editable=False)
@@ -83,17 +300,33 @@ class Invoice(TimeStampedModel):
                                            verbose_name=_(u'Invoice related'),
                                            editable=False)
     is_paid = models.BooleanField(_(u"is paid"), editable=False, default=True)
+    # Denormalized totals, kept up to date by update_totals()
+    subtotal = models.DecimalField(_(u"subtotal"), max_digits=12,
+                                   decimal_places=2, default=Decimal('0.00'),
+                                   editable=False)
+    paid_total = models.DecimalField(_(u"paid total"), max_digits=12,
+                                     decimal_places=2,
+                                     default=Decimal('0.00'), editable=False)
     is_exported = models.CharField(max_length=20, editable=False,
                                    choices=EXPORTED_CHOICES,
                                    default='no')
+    # Export which exported the invoice (its items)
+    export_batch = models.ForeignKey('Export', related_name='invoices',
+                                     blank=True, null=True, editable=False,
+                                     on_delete=models.SET_NULL,
+                                     verbose_name=_(u'export'))
 
     def credit_note_related_link(self):
-        if ((self.credit_note) and (not self.invoice_related) and
+        try:
+            credit_note = self.credit_note
+        except Invoice.DoesNotExist:
+            credit_note = None
+        if ((credit_note) and (not self.invoice_related_id) and
            (not self.is_credit_note)):
             change_url = urlresolvers.reverse('admin:invoice_invoice_change',
-                                              args=(self.credit_note.pk,))
+                                              args=(credit_note.pk,))
             return '<a href="%s">%s</a>' % (change_url,
-                                            self.credit_note.invoice_id)
+                                            credit_note.invoice_id)
         else:
             return self.invoice_id
     credit_note_related_link.short_description = _(u"Credit note")
@@ -117,40 +350,41 @@ class Invoice(TimeStampedModel):
 
     class Meta:
         ordering = ('-invoice_date', 'id')
+        index_together = (
+            # InvoiceQuerySet.get_due(), the equality columns first
+            ('invoiced', 'draft', 'invoice_date'),
+            # The export of the invoices not exported yet, walked by pk
+            ('is_exported', 'id'),
+            # The numbers of a year, InvoiceSequence seeds from their Max()
+            ('invoice_date', 'number'),
+        )
         verbose_name = _(u"invoice")
         verbose_name_plural = _(u"invoices")
 
     def save(self, *args, **kwargs):
 
-        # During the invoice creation we compute the ID with the pk (that's
-        # why we save the model before)
-        if not self.invoice_id:
+        with atomic():
+            if not self.invoice_id:
+                self._set_invoice_id()
+            self.is_paid = self._compute_is_paid()
             super(Invoice, self).save(*args, **kwargs)
-            inv_id_module = importlib.import_module(app_settings.INV_ID_MODULE)
-            self.number = self._get_next_number()
-            self.invoice_id = inv_id_module.encode(self.pk, self.number)
-            kwargs['force_insert'] = False
 
-        # We check if the invoice is paid
-        is_paid = False
         if self.is_credit_note:
-            # That a credit note, we consider it as "paid" since nobody need
-            # to pay for it
-            is_paid = True
             self.invoice_related._update_is_paid()
+
+    def _set_invoice_id(self):
+        # The ID of a new invoice is computed from a reserved serial number,
+        # so the invoice is inserted once with its ID. The pk can only stand
+        # in for it until the first serial is reserved (the backfill of the
+        # invoices created before the serials): after that, a pk can be the
+        # serial of another invoice.
+        inv_id_module = importlib.import_module(app_settings.INV_ID_MODULE)
+        self.number = self._get_next_number()
+        if self.pk and not InvoiceSequence.objects.has_serials():
+            serial = self.pk
         else:
-            try:
-                self.credit_note
-                # There is a credit note for this invoice
-                is_paid = (self.credit_note.total() >= self.total())
-            except:
-                # No credit note
-                total_paid = 0
-                for payment in self.payments.all():
-                    total_paid += payment.amount
-                is_paid = (total_paid >= self.total())
-        self.is_paid = is_paid
-        super(Invoice, self).save(*args, **kwargs)
+            serial = InvoiceSequence.objects.reserve_serial()
+        self.invoice_id = inv_id_module.encode(serial, self.number)
 
     def _get_next_number(self):
         """
@@ -165,24 +399,53 @@ class Invoice(TimeStampedModel):
 
             To get invoice full number use ``invoice_id`` field.
 
-        :return: string (generated next number)
+        :return: int (generated next number)
         """
-
-        # Recupere les facture de l annee
-        relative_invoices = Invoice.objects.filter(invoice_date__year=self.invoice_date.year)
-        # on prend le numero le plus eleve du champs number, sinon on met 0
-        last_number = relative_invoices.aggregate(Max('number'))['number__max'] or 0
-
-        return last_number + 1
+        return InvoiceSequence.objects.reserve(self.invoice_date.year)
 
     def total_amount(self):
         return format_currency(self.total(), self.currency)
     total_amount.short_description = _(u"total amount")
 
+    def _compute_is_paid(self):
+        if self.is_credit_note:
+            # That a credit note, we consider it as "paid" since nobody need
+            # to pay for it
+            return True
+        if self.pk:
+            try:
+                # There is a credit note for this invoice
+                return self.credit_note.subtotal >= self.subtotal
+            except Invoice.DoesNotExist:
+                pass
+        return self.paid_total >= self.subtotal
+
     def _update_is_paid(self):
         # Call the save() method in order to compute is the invoice is paid
         self.save()
 
+    def compute_totals(self):
+        """
+        Computes the items and payments totals from the database.
+
+        :return: tuple (subtotal, paid_total)
+        """
+        subtotal = Decimal('0.00')
+        for unit_price, quantity in self.items.values_list('unit_price',
+                                                           'quantity'):
+            subtotal += line_total(unit_price, quantity)
+        paid_total = self.payments.aggregate(
+            paid_total=Sum('amount'))['paid_total'] or Decimal('0.00')
+        return subtotal, paid_total
+
+    def update_totals(self):
+        """
+        Refreshes ``subtotal``, ``paid_total`` and ``is_paid``, then saves the
+        invoice.
+        """
+        self.subtotal, self.paid_total = self.compute_totals()
+        self.save()
+
     def last_payment(self):
         payments = self.payments.order_by('-paid_date')
         if payments:
@@ -192,10 +455,7 @@ class Invoice(TimeStampedModel):
     last_payment.short_description = _(u"last payment")
 
     def total(self):
-        total = Decimal('0.00')
-        for item in self.items.all():
-            total = total + item.total()
-        return total
+        return self.subtotal
     total.short_description = _(u"total")
 
     def file_name(self):
@@ -203,7 +463,7 @@ class Invoice(TimeStampedModel):
         return inv_name_module.filename(self)
 
     def generate_pdf(self):
-        return draw_pdf(self.pdf_path(), self)
+        return write_pdf(self.pdf_path(), self)
 
     def is_pdf_generated(self):
         return isfile(self.pdf_path())
@@ -214,55 +474,21 @@ class Invoice(TimeStampedModel):
 
     def send_invoice(self, to_email=None, subject=None,
                      template='invoice_email', images=()):
-        if self.recipient.email or to_email:
-            pdf = StringIO()
-            draw_pdf(pdf, self)
-            pdf.seek(0)
-
-            attachment = MIMEApplication(pdf.read())
-            attachment.add_header("Content-Disposition", "attachment",
-                                  filename=self.file_name())
-            pdf.close()
-
-            if not to_email:
-                to_email = self.recipient.email
-            if not subject:
-                subject = app_settings.INV_EMAIL_SUBJECT %\
-                    {"invoice_id": self.invoice_id}
-
-            text_tmpl = get_template('invoice/email/%s.txt' % template)
-            html_tmpl = get_template('invoice/email/%s.html' % template)
-
-            email_context = Context({
-                'invoice': self,
-                'date': date.today(),
-                "SITE_NAME": settings.SITE_NAME,
-                "INV_CURRENCY": app_settings.INV_CURRENCY,
-                "INV_CURRENCY_SYMBOL": app_settings.INV_CURRENCY_SYMBOL, })
-
-            text_content = text_tmpl.render(email_context)
-            html_content = html_tmpl.render(email_context)
-
-            email = EmailMultiAlternatives(subject=subject, body=text_content,
-                                           to=[to_email])
-            email.attach_alternative(html_content, "text/html")
-            email.attach(attachment)
-
-            for img in images:
-                fp = open(join(settings.STATIC_ROOT, img[0]), 'rb')
-                msgImage = MIMEImage(fp.read())
-                fp.close()
-                msgImage.add_header('Content-ID', '<' + img[1] + '>')
-                email.attach(msgImage)
-
-            email.send()
-
-            self.invoiced = True
-            self.save()
-
-            return True
-        else:
+        email = build_invoice_email(self, to_email=to_email, subject=subject,
+                                    template=template, images=images)
+        if email is None:
             return False
+        email.send()
+
+        self.invoiced = True
+        self.save()
+
+        return True
+
+
+def line_total(unit_price, quantity):
+    total = Decimal(str(unit_price * quantity))
+    return total.quantize(Decimal('0.01'))
 
 
 class InvoiceItem(models.Model):
@@ -279,8 +505,7 @@ class InvoiceItem(models.Model):
                                              auto_now=True)
 
     def total(self):
-        total = Decimal(str(self.unit_price * self.quantity))
-        return total.quantize(Decimal('0.01'))
+        return line_total(self.unit_price, self.quantity)
 
     def __unicode__(self):
         return self.description
@@ -290,6 +515,13 @@ class InvoiceItem(models.Model):
         verbose_name_plural = _(u"invoice items")
 
 
+def _payments_total_sql():
+    return (
+        "SELECT COALESCE(SUM(p.amount), 0) "
+        "FROM %s p WHERE p.invoice_id = %s.id" % (
+            InvoicePayment._meta.db_table, Invoice._meta.db_table))
+
+
 class InvoicePayment(models.Model):
 
     METHOD_CHOICES = (
@@ -311,10 +543,15 @@ class InvoicePayment(models.Model):
                                        help_text=_(u"eg. payment id"))
     is_exported = models.BooleanField(_(u"Is exported"), default=False,
                                       editable=False)
+    export_batch = models.ForeignKey('Export', related_name='payments',
+                                     blank=True, null=True, editable=False,
+                                     on_delete=models.SET_NULL,
+                                     verbose_name=_(u'export'))
     creation_date = models.DateTimeField(_(u"date of creation"),
                                          auto_now_add=True)
+    # Indexed for the delta exports
     modification_date = models.DateTimeField(_(u"date of modification"),
-                                             auto_now=True)
+                                             auto_now=True, db_index=True)
 
     def __unicode__(self):
         return self.amount
@@ -324,39 +561,280 @@ class InvoicePayment(models.Model):
         verbose_name_plural = _(u"invoice payments")
 
 
+_recompute = threading.local()
+
+
+@contextmanager
+def defer_invoice_recompute():
+    """
+    Postpones the totals and ``is_paid`` update triggered by item and payment
+    changes until the end of the block, then updates each changed invoice
+    once::
+
+        with defer_invoice_recompute():
+            for item in items:
+                item.save()
+
+    Blocks can be nested, invoices are updated when the outermost one exits.
+    They are also updated when the block raises an exception, the items
+    and payments saved before it are written (unless an enclosing
+    transaction rolls everything back).
+    """
+    outermost = getattr(_recompute, 'dirty', None) is None
+    if outermost:
+        _recompute.dirty = {}
+    try:
+        yield
+    except Exception:
+        if outermost:
+            # Do not hide the error of the block
+            _update_dirty_invoices(log_errors=True)
+        raise
+    else:
+        if outermost:
+            _update_dirty_invoices()
+    finally:
+        if outermost:
+            _recompute.dirty = None
+
+
+def _update_dirty_invoices(log_errors=False):
+    while _recompute.dirty:
+        pk, invoice = _recompute.dirty.popitem()
+        try:
+            invoice.update_totals()
+        except Exception:
+            if not log_errors:
+                raise
+            logger.exception(u"Cannot update the totals of invoice %s" %
+                             invoice.invoice_id)
+
+
+def _invoice_changed(invoice):
+    pdf_cache.invalidate(invoice.pk)
+    dirty = getattr(_recompute, 'dirty', None)
+    if dirty is None:
+        invoice.update_totals()
+    else:
+        dirty[invoice.pk] = invoice
+
+
 @receiver(post_save, sender=InvoicePayment)
 def payment_saved(sender, instance, using, **kwargs):
     payment = instance
-    payment.invoice._update_is_paid()
+    _invoice_changed(payment.invoice)
 
 
 @receiver(post_delete, sender=InvoicePayment)
 def payment_deleted(sender, instance, using, **kwargs):
     payment = instance
-    payment.invoice._update_is_paid()
+    _invoice_changed(payment.invoice)
 
 
 @receiver(post_save, sender=InvoiceItem)
 def item_saved(sender, instance, using, **kwargs):
     item = instance
-    item.invoice._update_is_paid()
+    _invoice_changed(item.invoice)
 
 
 @receiver(post_delete, sender=InvoiceItem)
 def item_deleted(sender, instance, using, **kwargs):
     item = instance
-    item.invoice._update_is_paid()
+    _invoice_changed(item.invoice)
+
+
+class SendJob(models.Model):
+    STATUS_CHOICES = (
+        ('running', _(u'running')),
+        ('done', _(u'done')),
+    )
+
+    status = models.CharField(_(u"status"), max_length=20,
+                              choices=STATUS_CHOICES, default='running')
+    # pk of the last invoice queued, the next due invoices are fetched after
+    # it
+    last_invoice = models.IntegerField(_(u"last invoice queued"), default=0)
+    sent_count = models.IntegerField(_(u"sent"), default=0)
+    failed_count = models.IntegerField(_(u"failed"), default=0)
+    finish_date = models.DateTimeField(_(u"date of end"), blank=True,
+                                       null=True)
+
+    creation_date = models.DateTimeField(_(u"date of creation"),
+                                         auto_now_add=True)
+    modification_date = models.DateTimeField(_(u"date of modification"),
+                                             auto_now=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.creation_date, self.get_status_display())
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name = _(u"send job")
+        verbose_name_plural = _(u"send jobs")
+
+
+class SendAttempt(models.Model):
+    STATUS_CHOICES = (
+        ('queued', _(u'queued')),
+        # The e-mail may have been sent if the job stopped in this state
+        ('sending', _(u'sending')),
+        ('sent', _(u'sent')),
+        ('failed', _(u'failed')),
+        ('unknown', _(u'unknown')),
+    )
+
+    job = models.ForeignKey(SendJob, related_name='attempts',
+                            verbose_name=_(u'send job'))
+    invoice = models.ForeignKey(Invoice, related_name='send_attempts',
+                                verbose_name=_(u'invoice'))
+    status = models.CharField(_(u"status"), max_length=20,
+                              choices=STATUS_CHOICES, default='queued')
+    tries = models.IntegerField(_(u"tries"), default=0)
+    error = models.TextField(_(u"error"), blank=True)
+    next_try = models.DateTimeField(_(u"next try"), blank=True, null=True)
+
+    creation_date = models.DateTimeField(_(u"date of creation"),
+                                         auto_now_add=True)
+    modification_date = models.DateTimeField(_(u"date of modification"),
+                                             auto_now=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.invoice_id, self.get_status_display())
+
+    class Meta:
+        unique_together = ('job', 'invoice')
+        verbose_name = _(u"send attempt")
+        verbose_name_plural = _(u"send attempts")
+
+
+def _pks(queryset):
+    """
+    Primary keys of ``queryset`` for a ``pk__in`` filter of an UPDATE on the
+    same table: a subquery, or a list on databases which can't select from
+    the updated table (MySQL).
+    """
+    pks = queryset.values_list('pk', flat=True)
+    if not connection.features.update_can_self_select:
+        pks = list(pks)
+    return pks
 
 
 class Export(models.Model):
+    STATUS_CHOICES = (
+        ('pending', _(u'pending')),
+        ('running', _(u'running')),
+        ('done', _(u'done')),
+        ('failed', _(u'failed')),
+    )
+
+    MODE_CHOICES = (
+        ('flags', _(u'unexported rows')),
+        ('delta', _(u'changes')),
+    )
+
     date = models.DateField(_(u"date"))
-    file = models.FileField(_(u"file"), upload_to='invoices/export')
+    file = models.FileField(_(u"file"), upload_to='invoices/export',
+                            blank=True)
+    mode = models.CharField(_(u"mode"), max_length=20, choices=MODE_CHOICES,
+                            default='flags')
+    # Delta exports: the rows modified until this date are exported
+    watermark = models.DateTimeField(_(u"watermark"), blank=True, null=True)
+    status = models.CharField(_(u"status"), max_length=20,
+                              choices=STATUS_CHOICES, default='done')
+    rows_done = models.IntegerField(_(u"rows exported"), default=0)
+    # Unknown with the gather_data_and_update_flags contract
+    rows_total = models.IntegerField(_(u"rows to export"), blank=True,
+                                     null=True)
+    rows_per_second = models.FloatField(_(u"rows per second"), blank=True,
+                                        null=True)
+    error = models.TextField(_(u"error"), blank=True)
+    start_date = models.DateTimeField(_(u"date of start"), blank=True,
+                                      null=True)
+    finish_date = models.DateTimeField(_(u"date of end"), blank=True,
+                                       null=True)
 
     creation_date = models.DateTimeField(_(u"date of creation"),
                                          auto_now_add=True)
     modification_date = models.DateTimeField(_(u"date of modification"),
                                              auto_now=True)
 
+    def claim(self, invoices, payments=None):
+        """
+        Marks ``invoices`` (their items) and ``payments`` as exported by this
+        export, with one UPDATE ... WHERE id IN (subquery) per model. Call it
+        in the transaction which creates the export.
+
+        The invoices become ``invoice_only``, or ``yes`` when they are paid
+        and all their payments are exported.
+        """
+        invoices.model.objects.filter(pk__in=_pks(invoices)).update(
+            export_batch=self, is_exported='invoice_only')
+        if payments is not None:
+            payments.model.objects.filter(pk__in=_pks(payments))\
+                .update(export_batch=self, is_exported=True)
+        self._touched_invoices().filter(
+            is_exported='invoice_only', is_paid=True)\
+            .exclude(payments__is_exported=False)\
+            .update(is_exported='yes')
+
+    def previous_watermark(self):
+        """
+        :return: the watermark of the last delta export done before this one,
+            or None if there is none
+        """
+        return Export.objects.filter(mode='delta', status='done',
+                                     pk__lt=self.pk)\
+            .aggregate(Max('watermark'))['watermark__max']
+
+    def changes(self):
+        """
+        :return: tuple (invoices, payments) querysets of the rows modified
+            between the previous watermark and the watermark of this delta
+            export
+        """
+        since = self.previous_watermark()
+        invoices = Invoice.objects.filter(modification_date__lte=self.watermark)
+        payments = InvoicePayment.objects.filter(
+            modification_date__lte=self.watermark)
+        if since is not None:
+            invoices = invoices.filter(modification_date__gt=since)
+            payments = payments.filter(modification_date__gt=since)
+        return invoices, payments
+
+    def release(self):
+        """
+        Marks the invoices and payments of this export as not exported.
+        """
+        with atomic():
+            self._touched_invoices().filter(is_exported='yes')\
+                .update(is_exported='invoice_only')
+            self.invoices.update(export_batch=None, is_exported='no')
+            self.payments.update(export_batch=None, is_exported=False)
+
+    def rollback(self):
+        """
+        Marks the invoices and payments of this export as not exported, then
+        deletes it.
+        """
+        with atomic():
+            self.release()
+            if self.file:
+                self.file.delete(save=False)
+            self.delete()
+
+    def progress(self):
+        if self.status == 'done':
+            return 100
+        if not self.rows_total:
+            return None
+        return min(100, self.rows_done * 100 // self.rows_total)
+    progress.short_description = _(u"progress (%)")
+
+    def _touched_invoices(self):
+        return Invoice.objects.filter(pk__in=_pks(Invoice.objects.filter(
+            models.Q(export_batch=self) |
+            models.Q(payments__export_batch=self))))
+
     def file_link(self):
         if self.file:
             file_url = "%s%s" % (settings.MEDIA_URL, self.file)
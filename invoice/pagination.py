@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from django.core.paginator import Paginator
+from django.db import connections
+
+from .conf import settings as app_settings
+
+
+def estimated_count(queryset):
+    """
+    :return: the number of rows of the table of ``queryset`` estimated by the
+        database planner, or None if the backend does not estimate it or the
+        queryset is filtered
+    """
+    if queryset.query.where or queryset.query.low_mark or\
+            queryset.query.high_mark is not None:
+        return None
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        # Updated by VACUUM and ANALYZE
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which counts the unfiltered tables above
+    INV_ADMIN_ESTIMATE_COUNT_ABOVE rows with the planner estimate instead of
+    a COUNT(*), which reads the whole table. The last page number may be a
+    bit off.
+    """
+    def _get_count(self):
+        if self._count is None:
+            threshold = app_settings.INV_ADMIN_ESTIMATE_COUNT_ABOVE
+            estimate = None
+            if threshold is not None and hasattr(self.object_list, 'query'):
+                estimate = estimated_count(self.object_list)
+            if estimate is not None and estimate > threshold:
+                self._count = estimate
+            else:
+                self._count = super(EstimatedCountPaginator,
+                                    self)._get_count()
+        return self._count
+    count = property(_get_count)
@@ -1,3 +1,5 @@
+import os
+import tempfile
 try:
     from django.utils import importlib
 except ImportError:
@@ -21,9 +23,96 @@ def footer_func(*args, **kwargs):
     inv_module.draw_footer(*args, **kwargs)
 
 
+_logos = {}
+
+
+def get_logo(path=None):
+    """
+    :return: an ImageReader of the logo (INV_LOGO by default), decoded once
+        per process when INV_PDF_CACHE_STATIC is set
+    """
+    from reportlab.lib.utils import ImageReader
+
+    path = path or settings.INV_LOGO
+    if not settings.INV_PDF_CACHE_STATIC:
+        return ImageReader(path)
+    if path not in _logos:
+        _logos[path] = ImageReader(path)
+    return _logos[path]
+
+
+def draw_static(canvas, name, draw_func):
+    """
+    Draws ``draw_func(canvas)``, the same on every page (header, footer...),
+    through the Form XObject ``name``: the form is recorded the first time it
+    is drawn on ``canvas`` and the following pages only refer to it. Without
+    INV_PDF_CACHE_STATIC, ``draw_func`` draws every time.
+    """
+    if not settings.INV_PDF_CACHE_STATIC:
+        canvas.saveState()
+        draw_func(canvas)
+        canvas.restoreState()
+        return
+
+    forms = getattr(canvas, '_invoice_forms', None)
+    if forms is None:
+        forms = canvas._invoice_forms = set()
+    if name not in forms:
+        # The page may be drawn from any corner, the form may cover it all
+        width, height = canvas._pagesize
+        canvas.beginForm(name, lowerx=-width, lowery=-height, upperx=width,
+                         uppery=height)
+        draw_func(canvas)
+        canvas.endForm()
+        forms.add(name)
+    canvas.doForm(name)
+
+
 def draw_pdf(*args, **kwargs):
     try:
         inv_module = importlib.import_module(settings.INV_MODULE)
         return inv_module.draw_pdf(*args, **kwargs)
     except:
         return False
+
+
+def draw_invoice(canvas, invoice):
+    """
+    Draws the pages of ``invoice`` on ``canvas``, a document of several
+    invoices. The INV_MODULE must have a ``draw_invoice(canvas, invoice)``
+    function.
+    """
+    inv_module = importlib.import_module(settings.INV_MODULE)
+    return inv_module.draw_invoice(canvas, invoice)
+
+
+def write_pdf(path, invoice):
+    """
+    Draws the invoice into ``path``. The PDF is drawn in a temporary file
+    which is then renamed, so ``path`` never holds a partial PDF.
+
+    :return: bool (True if the PDF has been written)
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another process
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            drawn = draw_pdf(tmp_file, invoice)
+        if drawn is False:
+            os.remove(tmp_path)
+            return False
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
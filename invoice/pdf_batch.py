@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import time
+from functools import partial
+from multiprocessing import Pool
+
+from django.db import connection
+
+from .models import Invoice
+from .conf import settings as inv_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class GenerationReport(object):
+    def __init__(self):
+        self.generated = 0
+        self.skipped = 0
+        self.failed = []
+        self.started = time.time()
+
+    @property
+    def processed(self):
+        return self.generated + self.skipped + len(self.failed)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.generated / elapsed if elapsed else 0.0
+
+    def __unicode__(self):
+        return u"%d PDF(s) generated, %d skipped, %d failed in %.1fs " \
+               u"(%.1f PDF/s)" % (self.generated, self.skipped,
+                                  len(self.failed), self.elapsed, self.rate)
+
+
+def generate_pdfs(queryset, processes=None, chunk_size=None, missing=False,
+                  progress=None):
+    """
+    Generates the PDF of every invoice of ``queryset`` into
+    ``INV_PDF_DIR``, sharing the work between ``processes`` worker
+    processes (default: ``INV_PDF_PROCESSES``, or the number of CPUs).
+
+    Each worker renders ``chunk_size`` invoices at a time, fetched with
+    their recipient, currency and items in a few queries. ``missing`` skips
+    the invoices whose PDF already exists. ``progress`` is called with the
+    report after each chunk.
+
+    :return: GenerationReport
+    """
+    processes = processes or inv_settings.INV_PDF_PROCESSES
+    chunk_size = chunk_size or inv_settings.INV_PDF_CHUNK_SIZE
+    report = GenerationReport()
+
+    pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    chunks = [pks[start:start + chunk_size]
+              for start in range(0, len(pks), chunk_size)]
+    worker = partial(generate_chunk, missing=missing)
+
+    if processes == 1:
+        results = (worker(chunk) for chunk in chunks)
+        pool = None
+    else:
+        # The forked workers must not share the parent's connection
+        connection.close()
+        pool = Pool(processes)
+        results = pool.imap_unordered(worker, chunks)
+
+    try:
+        for generated, skipped, failed in results:
+            report.generated += generated
+            report.skipped += skipped
+            report.failed.extend(failed)
+            if progress:
+                progress(report)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return report
+
+
+def generate_chunk(pks, missing=False):
+    """
+    Generates the PDF of the invoices ``pks``.
+
+    :return: tuple (generated, skipped, failed pks)
+    """
+    generated = skipped = 0
+    failed = []
+    invoices = Invoice.objects.filter(pk__in=pks)\
+        .select_related('recipient', 'currency')\
+        .prefetch_related('items')
+    for invoice in invoices:
+        if missing and invoice.is_pdf_generated():
+            skipped += 1
+            continue
+        try:
+            if invoice.generate_pdf():
+                generated += 1
+                continue
+        except Exception:
+            logger.exception(u"PDF generation failed for invoice %s" %
+                             invoice.invoice_id)
+        failed.append(invoice.pk)
+    return generated, skipped, failed
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the rendered invoice PDFs.
+
+A PDF is stored under a hash of everything it is drawn from (the values
+returned by the ``fingerprint_data(invoice)`` function of ``INV_MODULE``,
+``INV_MODULE`` and ``INV_PDF_TEMPLATE_VERSION``), so a changed invoice never
+gets a stale PDF.
+Entries are grouped by invoice, which lets the item and payment signals drop
+them all at once.
+"""
+import hashlib
+import os
+import shutil
+import time
+
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+try:
+    from django.utils import importlib
+except ImportError:
+    import importlib
+
+from .conf import settings as inv_settings
+from .pdf import draw_pdf
+from .utils.buffers import BLOCK_SIZE, SpooledBuffer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Without a fingerprint_data() in the INV_MODULE: the recipient attributes
+# which may be drawn as the billing address
+ADDRESS_ATTRIBUTES = ('invoice_contact_name', 'invoice_address_one',
+                      'invoice_address_two', 'invoice_town',
+                      'invoice_county', 'invoice_postcode', 'email')
+
+
+def invoice_fingerprint(invoice):
+    """
+    :return: string (hash of the data drawn in the invoice PDF)
+    """
+    parts = [inv_settings.INV_MODULE, inv_settings.INV_PDF_TEMPLATE_VERSION,
+             invoice.pk]
+    try:
+        inv_module = importlib.import_module(inv_settings.INV_MODULE)
+    except ImportError:
+        inv_module = None
+    if hasattr(inv_module, 'fingerprint_data'):
+        parts.extend(inv_module.fingerprint_data(invoice))
+    else:
+        parts.extend(default_fingerprint_data(invoice))
+
+    content = u'\x1f'.join([u'%s' % part for part in parts])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def default_fingerprint_data(invoice):
+    """
+    :return: list (the values an invoice layout may draw), for the
+        INV_MODULEs without ``fingerprint_data``
+    """
+    parts = [invoice.invoice_id, invoice.number,
+             invoice.invoice_date, invoice.invoice_cost_code,
+             invoice.is_credit_note, invoice.subtotal, invoice.paid_total,
+             invoice.is_paid]
+
+    currency = invoice.currency
+    if currency:
+        parts.extend([currency.code, currency.pre_symbol,
+                      currency.post_symbol])
+
+    recipient = invoice.recipient
+    address = getattr(invoice, 'address', None)
+    parts.append(recipient)
+    for attribute in ADDRESS_ATTRIBUTES:
+        parts.append(getattr(recipient, attribute, None))
+        parts.append(getattr(address, attribute, None))
+
+    items = getattr(invoice, '_prefetched_objects_cache', {}).get('items')
+    if items is not None:
+        items = sorted([(item.pk, item.description, item.unit_price,
+                         item.quantity) for item in items])
+    else:
+        items = invoice.items.order_by('pk').values_list(
+            'pk', 'description', 'unit_price', 'quantity')
+    for item in items:
+        parts.extend(item)
+    return parts
+
+
+class BasePDFCache(object):
+    """
+    ``max_size`` (bytes) and ``max_age`` (seconds) limit the cache, they
+    are checked every ``prune_frequency`` writes.
+    """
+    def __init__(self, max_size=None, max_age=None, prune_frequency=100):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.prune_frequency = prune_frequency
+        self._writes = 0
+
+    def get(self, invoice_pk, key):
+        raise NotImplementedError
+
+    def get_buffer(self, invoice_pk, key):
+        """
+        :return: SpooledBuffer, or None
+        """
+        content = self.get(invoice_pk, key)
+        if content is None:
+            return None
+        return SpooledBuffer(content)
+
+    def set(self, invoice_pk, key, content):
+        """
+        ``content`` is a string or a SpooledBuffer.
+        """
+        self._set(invoice_pk, key, content)
+        self._writes += 1
+        if self._writes % self.prune_frequency == 0:
+            self.prune()
+
+    def _set(self, invoice_pk, key, content):
+        raise NotImplementedError
+
+    def invalidate(self, invoice_pk):
+        raise NotImplementedError
+
+    def entries(self):
+        """
+        :return: list of (mtime, size, name) tuples
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def prune(self):
+        if not self.max_size and not self.max_age:
+            return
+        entries = sorted(self.entries())
+        total = sum([size for mtime, size, name in entries])
+        oldest = self.max_age and time.time() - self.max_age
+        for mtime, size, name in entries:
+            if not (oldest and mtime < oldest or
+                    self.max_size and total > self.max_size):
+                break
+            self.delete(name)
+            total -= size
+
+
+class FileSystemPDFCache(BasePDFCache):
+    """
+    Stores the PDFs in ``location/<invoice pk>/<key>.pdf``.
+    """
+    def __init__(self, location=None, **kwargs):
+        super(FileSystemPDFCache, self).__init__(**kwargs)
+        self.location = location or os.path.join(inv_settings.INV_PDF_DIR,
+                                                 'cache')
+
+    def _path(self, invoice_pk, key=None):
+        path = os.path.join(self.location, str(invoice_pk))
+        if key:
+            path = os.path.join(path, '%s.pdf' % key)
+        return path
+
+    def get(self, invoice_pk, key):
+        try:
+            with open(self._path(invoice_pk, key), 'rb') as fileobj:
+                return fileobj.read()
+        except IOError:
+            return None
+
+    def get_buffer(self, invoice_pk, key):
+        try:
+            with open(self._path(invoice_pk, key), 'rb') as fileobj:
+                buf = SpooledBuffer()
+                for chunk in iter(lambda: fileobj.read(BLOCK_SIZE), ''):
+                    buf.write(chunk)
+                return buf
+        except IOError:
+            return None
+
+    def _set(self, invoice_pk, key, content):
+        directory = self._path(invoice_pk)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        path = self._path(invoice_pk, key)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as fileobj:
+            if isinstance(content, SpooledBuffer):
+                content.write_to(fileobj)
+            else:
+                fileobj.write(content)
+        os.rename(tmp_path, path)
+
+    def invalidate(self, invoice_pk):
+        shutil.rmtree(self._path(invoice_pk), ignore_errors=True)
+
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.location):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def delete(self, name):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+class StoragePDFCache(BasePDFCache):
+    """
+    Stores the PDFs with a Django storage, in
+    ``location/<invoice pk>/<key>.pdf``.
+    """
+    def __init__(self, storage=None, location='invoices/pdf_cache',
+                 **kwargs):
+        super(StoragePDFCache, self).__init__(**kwargs)
+        if isinstance(storage, basestring):
+            module, name = storage.rsplit('.', 1)
+            storage = getattr(importlib.import_module(module), name)()
+        self.storage = storage or default_storage
+        self.location = location
+
+    def _path(self, invoice_pk, key=None):
+        path = '%s/%s' % (self.location, invoice_pk)
+        if key:
+            path = '%s/%s.pdf' % (path, key)
+        return path
+
+    def get(self, invoice_pk, key):
+        path = self._path(invoice_pk, key)
+        if not self.storage.exists(path):
+            return None
+        fileobj = self.storage.open(path, 'rb')
+        try:
+            return fileobj.read()
+        finally:
+            fileobj.close()
+
+    def _set(self, invoice_pk, key, content):
+        path = self._path(invoice_pk, key)
+        if not self.storage.exists(path):
+            if isinstance(content, SpooledBuffer):
+                content = File(content.file)
+            else:
+                content = ContentFile(content)
+            self.storage.save(path, content)
+
+    def invalidate(self, invoice_pk):
+        directory = self._path(invoice_pk)
+        try:
+            files = self.storage.listdir(directory)[1]
+        except OSError:
+            return
+        for name in files:
+            self.storage.delete('%s/%s' % (directory, name))
+
+    def entries(self):
+        entries = []
+        for directory in self.storage.listdir(self.location)[0]:
+            directory = '%s/%s' % (self.location, directory)
+            for name in self.storage.listdir(directory)[1]:
+                path = '%s/%s' % (directory, name)
+                mtime = time.mktime(
+                    self.storage.modified_time(path).timetuple())
+                entries.append((mtime, self.storage.size(path), path))
+        return entries
+
+    def delete(self, name):
+        self.storage.delete(name)
+
+
+_cache = []
+
+
+def get_pdf_cache():
+    """
+    :return: the cache set by ``INV_PDF_CACHE_BACKEND``, or None
+    """
+    if not _cache:
+        backend = inv_settings.INV_PDF_CACHE_BACKEND
+        if backend:
+            module, name = backend.rsplit('.', 1)
+            backend = getattr(importlib.import_module(module), name)(
+                **inv_settings.INV_PDF_CACHE_OPTIONS)
+        _cache.append(backend)
+    return _cache[0]
+
+
+def render_pdf_buffer(invoice):
+    """
+    :return: SpooledBuffer (the PDF), or None if it cannot be drawn
+    """
+    buf = SpooledBuffer()
+    if draw_pdf(buf, invoice) is False:
+        buf.close()
+        return None
+    return buf
+
+
+def render_pdf(invoice):
+    """
+    :return: string (the PDF content), or None if it cannot be drawn
+    """
+    buf = render_pdf_buffer(invoice)
+    if buf is None:
+        return None
+    with buf:
+        return buf.getvalue()
+
+
+def _store(cache, invoice, key, content):
+    try:
+        # Drop the PDFs of the previous versions of the invoice
+        cache.invalidate(invoice.pk)
+        cache.set(invoice.pk, key, content)
+    except Exception:
+        logger.exception(u"Cannot store the PDF of invoice %s" %
+                         invoice.invoice_id)
+
+
+def get_pdf(invoice):
+    """
+    Returns the PDF of ``invoice`` from the cache, rendering and storing it
+    on a miss.
+
+    :return: string (the PDF content), or None if it cannot be drawn
+    """
+    cache = get_pdf_cache()
+    if cache is None:
+        return render_pdf(invoice)
+
+    key = invoice_fingerprint(invoice)
+    content = cache.get(invoice.pk, key)
+    if content is None:
+        content = render_pdf(invoice)
+        if content is not None:
+            _store(cache, invoice, key, content)
+    return content
+
+
+def get_pdf_buffer(invoice):
+    """
+    Same as ``get_pdf``, but the PDF is read, drawn and stored through a
+    SpooledBuffer: a large PDF stays in a temporary file. Close the buffer
+    once read.
+
+    :return: SpooledBuffer, or None if the PDF cannot be drawn
+    """
+    cache = get_pdf_cache()
+    if cache is None:
+        return render_pdf_buffer(invoice)
+
+    key = invoice_fingerprint(invoice)
+    buf = cache.get_buffer(invoice.pk, key)
+    if buf is None:
+        buf = render_pdf_buffer(invoice)
+        if buf is not None:
+            _store(cache, invoice, key, buf)
+    return buf
+
+
+def invalidate(invoice_pk):
+    cache = get_pdf_cache()
+    if cache is not None:
+        cache.invalidate(invoice_pk)
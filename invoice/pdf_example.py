@@ -1,3 +1,5 @@
+from decimal import Decimal
+
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.platypus import Table
 from reportlab.lib.pagesizes import A4
@@ -8,9 +10,9 @@ from reportlab.lib.units import cm
 # except ImportError:
 #     import importlib
 
-from invoice.conf import settings
 from invoice.utils import format_currency
-from .pdf import header_func, footer_func, address_func
+from .pdf import header_func, footer_func, address_func, draw_static,\
+    get_logo
 
 
 def draw_header(canvas):
@@ -19,7 +21,7 @@ def draw_header(canvas):
     canvas.setFillColorRGB(0.2, 0.2, 0.2)
     canvas.setFont('Helvetica', 16)
     canvas.drawString(18 * cm, -1 * cm, 'Invoice')
-    canvas.drawInlineImage(settings.INV_LOGO, 1 * cm, -1 * cm, 250, 16)
+    canvas.drawImage(get_logo(), 1 * cm, -1 * cm, 250, 16)
     canvas.setLineWidth(4)
     canvas.line(0, -1.25 * cm, 21.7 * cm, -1.25 * cm)
 
@@ -61,23 +63,65 @@ def draw_footer(canvas):
     canvas.drawText(textobject)
 
 
-def draw_pdf(buffer, invoice):
-    """ Draws the invoice """
-    canvas = Canvas(buffer, pagesize=A4)
+# Attributes of ``invoice.address`` drawn as the client address, then the
+# ``invoice_name`` of its country
+ADDRESS_ATTRIBUTES = ('invoice_contact_name', 'invoice_address_one',
+                      'invoice_address_two', 'invoice_town',
+                      'invoice_county', 'invoice_postcode')
+
+
+# Items table layout: fixed row height, the rows of a page stop above the
+# footer
+ROW_HEIGHT = 0.6 * cm
+FIRST_PAGE_TOP = -8 * cm
+NEXT_PAGE_TOP = -2.5 * cm
+ITEMS_BOTTOM = -26.5 * cm
+# Items read per query when they are not prefetched
+ITEMS_CHUNK_SIZE = 1000
+
+
+def invoice_items(invoice, chunk_size=ITEMS_CHUNK_SIZE):
+    """
+    Iterates over the items of ``invoice``: the prefetched ones
+    (``prefetch_related('items')``), or ``chunk_size`` items per query
+    seeking after the last pk, so only one chunk is in memory.
+    """
+    prefetched = getattr(invoice, '_prefetched_objects_cache', {})
+    if 'items' in prefetched:
+        for item in prefetched['items']:
+            yield item
+        return
+
+    items = invoice.items.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = items
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        for item in chunk:
+            yield item
+        last_pk = chunk[-1].pk
+
+
+def draw_page(canvas, invoice, page_number):
+    """ Draws the parts of a page around the items """
     canvas.translate(0, 29.7 * cm)
     canvas.setFont('Helvetica', 10)
 
-    canvas.saveState()
-    header_func(canvas)
-    canvas.restoreState()
+    # The static parts are drawn once per canvas, then reused
+    draw_static(canvas, 'invoice_header', header_func)
+    draw_static(canvas, 'invoice_footer', footer_func)
 
-    canvas.saveState()
-    footer_func(canvas)
-    canvas.restoreState()
+    if page_number > 1:
+        canvas.drawString(1.5 * cm, -1.9 * cm, u'Invoice ID: %s (continued)' %
+                          invoice.invoice_id)
+        canvas.drawRightString(20 * cm, -1.9 * cm, u'Page %d' % page_number)
+        return
 
-    canvas.saveState()
-    address_func(canvas)
-    canvas.restoreState()
+    draw_static(canvas, 'invoice_address', address_func)
 
     # Client address
     textobject = canvas.beginText(1.5 * cm, -2.5 * cm)
@@ -103,19 +147,22 @@ def draw_pdf(buffer, invoice):
         '%d %b %Y'))
     canvas.drawText(textobject)
 
-    # Items
+
+def draw_items(canvas, top, rows, carried_in, last_row):
+    """
+    Draws the items table of a page at ``top``: the header, the amount
+    carried in from the previous page (if any), the ``rows`` and
+    ``last_row`` (the total or the amount carried forward).
+    """
     data = [[u'Quantity', u'Description', u'Amount', u'Total'], ]
-    for item in invoice.items.all():
-        data.append([
-            item.quantity,
-            item.description,
-            format_currency(item.unit_price, invoice.currency),
-            format_currency(item.total(), invoice.currency)
-        ])
-    data.append([u'', u'', u'Total:', format_currency(invoice.total(),
-                 invoice.currency)])
-    table = Table(data, colWidths=[2 * cm, 11 * cm, 3 * cm, 3 * cm])
-    table.setStyle([
+    if carried_in is not None:
+        data.append([u'', u'', u'Carried in:', carried_in])
+    data.extend(rows)
+    data.append([u'', u'', last_row[0], last_row[1]])
+
+    table = Table(data, colWidths=[2 * cm, 11 * cm, 3 * cm, 3 * cm],
+                  rowHeights=[ROW_HEIGHT] * len(data))
+    style = [
         ('FONT', (0, 0), (-1, -1), 'Helvetica'),
         ('FONTSIZE', (0, 0), (-1, -1), 10),
         ('TEXTCOLOR', (0, 0), (-1, -1), (0.2, 0.2, 0.2)),
@@ -123,11 +170,95 @@ def draw_pdf(buffer, invoice):
         ('GRID', (-2, -1), (-1, -1), 1, (0.7, 0.7, 0.7)),
         ('ALIGN', (-2, 0), (-1, -1), 'RIGHT'),
         ('BACKGROUND', (0, 0), (-1, 0), (0.8, 0.8, 0.8)),
-    ])
-    tw, th, = table.wrapOn(canvas, 15 * cm, 19 * cm)
-    table.drawOn(canvas, 1 * cm, -8 * cm - th)
+    ]
+    if carried_in is not None:
+        style.append(('FONT', (0, 1), (-1, 1), 'Helvetica-Oblique'))
+    table.setStyle(style)
+    tw, th, = table.wrapOn(canvas, 19 * cm, top - ITEMS_BOTTOM)
+    table.drawOn(canvas, 1 * cm, top - th)
+
+
+def page_capacity(top, carried_in):
+    """ Number of item rows of a page """
+    rows = int((top - ITEMS_BOTTOM) / ROW_HEIGHT)
+    # The header and the total (or carried forward) rows
+    rows -= 2
+    if carried_in:
+        rows -= 1
+    return rows
+
+
+def draw_invoice(canvas, invoice):
+    """
+    Draws the pages of the invoice on ``canvas``, which may hold other
+    invoices. The items flow over as many pages as needed, each page repeats
+    the table header and carries the subtotal forward. The items are read as
+    they are drawn, the rows of one page only are kept.
+    """
+    currency = invoice.currency
+
+    page_number = 1
+    draw_page(canvas, invoice, page_number)
+    top = FIRST_PAGE_TOP
+    carried_in = None
+    capacity = page_capacity(top, False)
+    subtotal = Decimal('0.00')
+    rows = []
+    for item in invoice_items(invoice):
+        if len(rows) == capacity:
+            # The page is full and there is another item
+            draw_items(canvas, top, rows, carried_in,
+                       (u'Carried forward:',
+                        format_currency(subtotal, currency)))
+            canvas.showPage()
+            page_number += 1
+            draw_page(canvas, invoice, page_number)
+            top = NEXT_PAGE_TOP
+            carried_in = format_currency(subtotal, currency)
+            capacity = page_capacity(top, True)
+            rows = []
+        total = item.total()
+        rows.append([
+            item.quantity,
+            item.description,
+            format_currency(item.unit_price, currency),
+            format_currency(total, currency)
+        ])
+        subtotal += total
+    draw_items(canvas, top, rows, carried_in,
+               (u'Total:', format_currency(invoice.total(), currency)))
 
     canvas.showPage()
+
+
+def fingerprint_data(invoice):
+    """
+    Returns the values drawn by ``draw_invoice``: the PDF cache stores the
+    PDF under their hash (see ``invoice.pdf_cache.invoice_fingerprint``).
+    Keep it in step with the drawing.
+    """
+    currency = invoice.currency
+    data = [invoice.invoice_id, invoice.invoice_date, invoice.total()]
+    if currency:
+        data.extend([currency.code, currency.pre_symbol,
+                     currency.post_symbol])
+
+    address = getattr(invoice, 'address', None)
+    for attribute in ADDRESS_ATTRIBUTES:
+        data.append(getattr(address, attribute, None))
+    country = getattr(address, 'country', None)
+    data.append(getattr(country, 'invoice_name', None))
+
+    for item in invoice_items(invoice):
+        data.extend([item.quantity, item.description, item.unit_price])
+    return data
+
+
+def draw_pdf(buffer, invoice):
+    """ Draws the invoice """
+    # Compressed pages, ReportLab keeps them in memory until save()
+    canvas = Canvas(buffer, pagesize=A4, pageCompression=1)
+    draw_invoice(canvas, invoice)
     canvas.save()
 
     return canvas
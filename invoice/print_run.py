@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Print runs: many invoices in one PDF, or in a ZIP of their PDFs.
+"""
+import os
+import zipfile
+from itertools import chain, islice
+from StringIO import StringIO
+
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.lib.pagesizes import A4
+
+from .pdf import draw_invoice
+from .pdf_cache import get_pdf
+
+# Invoices per volume of a merged print run, ReportLab keeps the pages of a
+# PDF in memory until it is saved
+VOLUME_SIZE = 500
+
+
+def iter_invoices(queryset):
+    """
+    Iterates over the invoices of ``queryset``, one chunk of them in memory
+    (their items are read by the layout).
+    """
+    return queryset.select_related('currency').chunked_iterator()
+
+
+def iter_volumes(invoices, volume_size=VOLUME_SIZE):
+    """
+    Splits ``invoices`` in iterators of ``volume_size`` invoices, each one
+    must be consumed before the next one is taken.
+    """
+    invoices = iter(invoices)
+    for first in invoices:
+        yield chain([first], islice(invoices, volume_size - 1))
+
+
+def volume_name(path, number):
+    """
+    :return: ``path`` suffixed with the volume number (``run-001.pdf``)
+    """
+    root, extension = os.path.splitext(path)
+    return '%s-%03d%s' % (root, number, extension)
+
+
+def write_merged_pdf(invoices, fileobj, progress=None):
+    """
+    Draws ``invoices`` one after the other in one PDF written to
+    ``fileobj``: the fonts, the logo and the static parts are stored once
+    for all of them. Each invoice has an outline entry.
+
+    :return: the number of invoices drawn
+    """
+    canvas = Canvas(fileobj, pagesize=A4, pageCompression=1)
+    count = 0
+    for invoice in invoices:
+        key = 'invoice-%s' % invoice.pk
+        canvas.bookmarkPage(key)
+        canvas.addOutlineEntry(invoice.invoice_id, key)
+        draw_invoice(canvas, invoice)
+        count += 1
+        if progress is not None:
+            progress(count)
+    canvas.save()
+    return count
+
+
+def write_zip(invoices, fileobj, progress=None):
+    """
+    Writes the PDF of each of ``invoices`` (through the PDF cache) to a ZIP
+    archive in ``fileobj`` as soon as it is drawn.
+
+    :return: the number of PDFs written
+    """
+    count = 0
+    archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED,
+                              allowZip64=True)
+    try:
+        for name, content in iter_pdf_entries(invoices):
+            archive.writestr(name, content)
+            count += 1
+            if progress is not None:
+                progress(count)
+    finally:
+        archive.close()
+    return count
+
+
+def write_print_run(queryset, path, format='pdf', volume_size=VOLUME_SIZE,
+                    progress=None):
+    """
+    Writes the invoices of ``queryset`` to ``path``: a ZIP of their PDFs
+    (``format='zip'``), or merged PDFs of ``volume_size`` invoices
+    (``format='pdf'``, ``path`` is then suffixed with ``-001``, ``-002``...
+    when there is more than one volume).
+
+    :return: the paths of the written files
+    """
+    invoices = iter_invoices(queryset)
+    if format == 'zip':
+        with open(path, 'wb') as fileobj:
+            write_zip(invoices, fileobj, progress)
+        return [path]
+
+    total = queryset.count()
+    if not volume_size or total <= volume_size:
+        with open(path, 'wb') as fileobj:
+            write_merged_pdf(invoices, fileobj, progress)
+        return [path]
+
+    paths = []
+    done = [0]
+
+    def volume_progress(count):
+        if progress is not None:
+            progress(done[0] + count)
+
+    for volume in iter_volumes(invoices, volume_size):
+        volume_path = volume_name(path, len(paths) + 1)
+        with open(volume_path, 'wb') as fileobj:
+            done[0] += write_merged_pdf(volume, fileobj, volume_progress)
+        paths.append(volume_path)
+    return paths
+
+
+class ZipOutput(object):
+    """
+    Write-only file for ZipFile, which only needs ``tell()`` when the
+    entries are added with ``writestr()``: the bytes written are taken back
+    by pieces, so that an archive is sent while it is written.
+    """
+    def __init__(self):
+        self.position = 0
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = ''.join(self.pieces)
+        del self.pieces[:]
+        return data
+
+
+def iter_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yields the bytes of a ZIP archive of ``entries``, (name, content)
+    pairs, as soon as each entry is written.
+    """
+    output = ZipOutput()
+    archive = zipfile.ZipFile(output, 'w', compression, allowZip64=True)
+    for name, content in entries:
+        archive.writestr(name, content)
+        yield output.take()
+    archive.close()
+    yield output.take()
+
+
+def iter_pdf_entries(invoices):
+    """
+    Yields the (file name, PDF) of each of ``invoices``, through the PDF
+    cache.
+    """
+    for invoice in invoices:
+        content = get_pdf(invoice)
+        if content is None:
+            raise Exception(u"The PDF of invoice %s cannot be drawn" %
+                            invoice.invoice_id)
+        yield invoice.file_name(), content
+
+
+def iter_volume_entries(invoices, file_name, volume_size=VOLUME_SIZE):
+    """
+    Yields the (file name, merged PDF) of each volume of ``volume_size``
+    invoices, named after ``file_name`` like ``write_print_run()`` names
+    them. Only one volume is in memory at a time.
+    """
+    for number, volume in enumerate(iter_volumes(invoices, volume_size), 1):
+        output = StringIO()
+        write_merged_pdf(volume, output)
+        yield volume_name(file_name, number), output.getvalue()
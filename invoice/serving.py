@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+File downloads, handed over to the web server when it can send them itself
+(X-Sendfile, X-Accel-Redirect), with ETag and Range support otherwise.
+"""
+import os
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5
+    StreamingHttpResponse = HttpResponse
+from django.utils.http import http_date, parse_etags, quote_etag
+
+from .conf import settings as inv_settings
+
+BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def serve_file(request, path, file_name, content_type='application/pdf'):
+    """
+    Sends the file ``path`` as an attachment named ``file_name``, using the
+    ``INV_SERVE_BACKEND`` method.
+    """
+    stat = os.stat(path)
+    etag = quote_etag('%x-%x' % (int(stat.st_mtime), stat.st_size))
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (if_none_match.strip() == '*' or
+                          etag in [quote_etag(e)
+                                   for e in parse_etags(if_none_match)]):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    backend = inv_settings.INV_SERVE_BACKEND
+    if backend == 'xsendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    elif backend == 'xaccel':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = inv_settings.INV_SERVE_XACCEL_PREFIX +\
+            os.path.relpath(path, inv_settings.INV_PDF_DIR)
+    else:
+        response = _file_response(request, path, stat.st_size, etag,
+                                  content_type)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
+    return response
+
+
+def _file_response(request, path, size, etag, content_type):
+    start, end = 0, size - 1
+    byte_range = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range and (not if_range or if_range == etag):
+        byte_range = parse_range(byte_range, size)
+        if byte_range is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, end = byte_range
+
+    length = end - start + 1
+    response = StreamingHttpResponse(file_iterator(path, start, length),
+                                     content_type=content_type)
+    if length != size:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def parse_range(header, size):
+    """
+    Parses a single ``bytes=`` range (multiple ranges are not supported).
+
+    :return: tuple (start, end) of the inclusive range, or None if it cannot
+        be satisfied
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+def file_iterator(path, start=0, length=None, block_size=BLOCK_SIZE):
+    with open(path, 'rb') as fileobj:
+        fileobj.seek(start)
+        while length is None or length > 0:
+            size = block_size if length is None else min(block_size, length)
+            data = fileobj.read(size)
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
@@ -1,10 +1,41 @@
 import datetime
+import os
+import shutil
+import tempfile
+import zipfile
+from decimal import Decimal
+from StringIO import StringIO
 
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.core import urlresolvers
+from django.utils import timezone
+from django.core import mail
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from addressbook.models import Address, Country
 
-from .models import Invoice
+from .importer import import_invoices, read_csv
+from . import pdf_example, export_example
+from .pdf import draw_static
+from .pdf_batch import generate_pdfs
+from .pdf_cache import FileSystemPDFCache, render_pdf, invoice_fingerprint
+from .print_run import write_print_run, iter_zip, iter_volume_entries,\
+    iter_invoices
+from .serving import parse_range
+from .utils.buffers import SpooledBuffer
+from .utils import friendly_id
+from .dispatch import run_send_job
+from .conf import settings as inv_settings
+from .benchmarks import BENCHMARKS, make_fixture, delete_fixture
+from .pagination import EstimatedCountPaginator
+from .export import queue_export, claim_next_export, run_export,\
+    JSONLinesWriter, FECWriter, FEC_COLUMNS
+from .mailing import send_invoices, get_inline_image, build_invoice_email,\
+    render_pdf as render_invoice_pdf
+from .models import Invoice, InvoiceItem, InvoicePayment, InvoiceSequence,\
+    SendJob, SendAttempt, Export, defer_invoice_recompute
 
 
 class InvoiceTestCase(TestCase):
@@ -59,3 +90,768 @@ class InvoiceTestCase(TestCase):
         inv.invoice_date = tomorrow
         inv.save()
         self.assertEquals(len(Invoice.objects.get_due()), 0)
+
+
+class InvoiceTotalsTestCase(TestCase):
+    def setUp(self):
+        usr = User.objects.create(username='test',
+                                  email='example@example.com')
+        self.inv = Invoice.objects.create(recipient=usr)
+
+    def testTotalsFollowItemsAndPayments(self):
+        inv = self.inv
+        item = InvoiceItem.objects.create(invoice=inv, description='A',
+                                          unit_price=Decimal('10.00'),
+                                          quantity=Decimal('3'))
+        InvoiceItem.objects.create(invoice=inv, description='B',
+                                   unit_price=Decimal('0.50'))
+
+        inv = Invoice.objects.get(pk=inv.pk)
+        self.assertEquals(inv.subtotal, Decimal('30.50'))
+        self.assertEquals(inv.total(), Decimal('30.50'))
+        self.assertFalse(inv.is_paid)
+
+        InvoicePayment.objects.create(invoice=inv, amount=Decimal('30.50'))
+        inv = Invoice.objects.get(pk=inv.pk)
+        self.assertEquals(inv.paid_total, Decimal('30.50'))
+        self.assertTrue(inv.is_paid)
+
+        item.delete()
+        inv = Invoice.objects.get(pk=inv.pk)
+        self.assertEquals(inv.subtotal, Decimal('0.50'))
+        self.assertEquals(inv.compute_totals(),
+                          (inv.subtotal, inv.paid_total))
+
+    def testWithPayments(self):
+        InvoiceItem.objects.create(invoice=self.inv, description='A',
+                                   unit_price=Decimal('12.25'),
+                                   quantity=Decimal('2'))
+        InvoicePayment.objects.create(invoice=self.inv,
+                                      amount=Decimal('4.50'))
+
+        inv = Invoice.objects.with_payments().get(pk=self.inv.pk)
+        self.assertEquals(inv.subtotal, Decimal('24.50'))
+        self.assertEquals(Decimal(str(inv.paid_sum)), Decimal('4.50'))
+
+    def testSubtotalRounding(self):
+        # 0.125 is rounded half to even, like the invoice detail and the PDF
+        InvoiceItem.objects.create(invoice=self.inv, description='A',
+                                   unit_price=Decimal('0.25'),
+                                   quantity=Decimal('0.50'))
+        inv = Invoice.objects.get(pk=self.inv.pk)
+        self.assertEquals(inv.subtotal, Decimal('0.12'))
+        self.assertEquals(inv.total(), Decimal('0.12'))
+
+    def testDeferRecompute(self):
+        with defer_invoice_recompute():
+            for i in range(3):
+                InvoiceItem.objects.create(invoice=self.inv, description='A',
+                                           unit_price=Decimal('1.00'))
+            self.assertEquals(
+                Invoice.objects.get(pk=self.inv.pk).subtotal, Decimal('0'))
+        self.assertEquals(Invoice.objects.get(pk=self.inv.pk).subtotal,
+                          Decimal('3.00'))
+
+    def testRebuildTotals(self):
+        InvoiceItem.objects.create(invoice=self.inv, description='A',
+                                   unit_price=Decimal('2.00'))
+        long_ago = timezone.now() - datetime.timedelta(days=30)
+        Invoice.objects.filter(pk=self.inv.pk).update(
+            subtotal=Decimal('1.00'), modification_date=long_ago)
+        call_command('rebuild_invoice_totals', stdout=StringIO())
+        inv = Invoice.objects.get(pk=self.inv.pk)
+        self.assertEquals(inv.subtotal, Decimal('2.00'))
+        # Seen by the next delta export
+        self.assertTrue(inv.modification_date > long_ago)
+
+    def testDeferRecomputeError(self):
+        def save_items():
+            with defer_invoice_recompute():
+                InvoiceItem.objects.create(invoice=self.inv, description='A',
+                                           unit_price=Decimal('2.00'))
+                raise ValueError(u"Error after the first item")
+        self.assertRaises(ValueError, save_items)
+        # The item is saved, so is its invoice total
+        self.assertEquals(Invoice.objects.get(pk=self.inv.pk).subtotal,
+                          Decimal('2.00'))
+
+
+class InvoiceSeekTestCase(TestCase):
+    def testSeek(self):
+        recipient = User.objects.create(username='test')
+        today = datetime.date.today()
+        for days in (0, 0, 1, 1, 1, 2):
+            Invoice.objects.create(
+                recipient=recipient,
+                invoice_date=today - datetime.timedelta(days))
+        expected = list(Invoice.objects.values_list('invoice_date', 'pk'))
+
+        seen = []
+        key = ()
+        while True:
+            page = list(Invoice.objects.seek(*key)
+                        .values_list('invoice_date', 'pk')[:4])
+            if not page:
+                break
+            seen.extend(page)
+            key = page[-1]
+        self.assertEquals(seen, expected)
+
+    def testPaginatorCounts(self):
+        # No planner estimate on SQLite, the paginator counts
+        Invoice.objects.create(recipient=User.objects.create(username='a'))
+        paginator = EstimatedCountPaginator(Invoice.objects.all(), 10)
+        self.assertEquals(paginator.count, 1)
+
+
+class FriendlyIdTestCase(TestCase):
+    def setUp(self):
+        # The whole range, strided, and both ends
+        size = friendly_id.SIZE
+        self.serials = range(0, size + 1, 997) + range(1000) +\
+            range(size - 1000, size + 1)
+
+    def testRoundTrip(self):
+        strings = friendly_id.encode_many(self.serials)
+        self.assertEquals(strings, map(friendly_id.encode, self.serials))
+        self.assertEquals(friendly_id.decode_many(strings), self.serials)
+        self.assertEquals(map(friendly_id.decode, strings), self.serials)
+        self.assertEquals(len(set(strings)), len(set(self.serials)))
+        for string in strings:
+            self.assertEquals(len(string), friendly_id.LENGTH)
+
+    def testPerfectHash(self):
+        hashes = set()
+        for serial in self.serials:
+            hashed = friendly_id.perfect_hash(serial)
+            self.assertEquals(friendly_id.perfect_unhash(hashed), serial)
+            hashes.add(hashed)
+        self.assertEquals(len(hashes), len(set(self.serials)))
+        self.assertEquals(friendly_id.INVERSE,
+                          friendly_id.SIZE + 1 - friendly_id.PERIOD)
+
+    def testInvalid(self):
+        size = friendly_id.SIZE
+        invalid = ['', '3', '3' * (friendly_id.LENGTH + 1),
+                   '1' * friendly_id.LENGTH,
+                   friendly_id.VALID_CHARS[-1] * friendly_id.LENGTH]
+        self.assertEquals(friendly_id.decode_many(invalid),
+                          [None] * len(invalid))
+        self.assertEquals(map(friendly_id.decode, invalid),
+                          [None] * len(invalid))
+        self.assertEquals(friendly_id.encode_many([-1, size + 1]),
+                          [None, None])
+
+    def testBenchmark(self):
+        output = []
+        BENCHMARKS['ids'](output.append, repeat=1, count=100)
+        self.assertTrue(output[0].startswith(u'encode: '))
+
+
+class InvoiceSequenceTestCase(TestCase):
+    def testReserve(self):
+        self.assertEquals(InvoiceSequence.objects.reserve(2015), 1)
+        self.assertEquals(InvoiceSequence.objects.reserve(2015, 10), 2)
+        self.assertEquals(InvoiceSequence.objects.reserve(2015), 12)
+        self.assertEquals(InvoiceSequence.objects.reserve(2016), 1)
+
+    def testStartsAfterExistingInvoices(self):
+        usr = User.objects.create(username='test')
+        inv = Invoice.objects.create(recipient=usr,
+                                     invoice_date=datetime.date(2014, 5, 1))
+        Invoice.objects.filter(pk=inv.pk).update(number=41)
+        InvoiceSequence.objects.all().delete()
+
+        inv = Invoice.objects.create(recipient=usr,
+                                     invoice_date=datetime.date(2014, 6, 1))
+        self.assertEquals(inv.number, 42)
+
+    def testClearedIdGetsNewSerial(self):
+        usr = User.objects.create(username='test')
+        cleared = Invoice.objects.create(recipient=usr)
+        Invoice.objects.filter(pk=cleared.pk).update(invoice_id='')
+        # The next invoice gets the pk of the first one as serial
+        InvoiceSequence.objects.filter(year=InvoiceSequence.objects.SERIAL)\
+            .update(last_number=cleared.pk - 1)
+        other = Invoice.objects.create(recipient=usr)
+
+        cleared = Invoice.objects.get(pk=cleared.pk)
+        cleared.save()
+        self.assertNotEquals(cleared.invoice_id, other.invoice_id)
+
+    def testBackfillUsesPk(self):
+        usr = User.objects.create(username='test')
+        inv = Invoice.objects.create(recipient=usr)
+        Invoice.objects.filter(pk=inv.pk).update(invoice_id='')
+        InvoiceSequence.objects.all().delete()
+
+        inv = Invoice.objects.get(pk=inv.pk)
+        inv.save()
+        self.assertEquals(inv.invoice_id,
+                          friendly_id.encode(inv.pk, inv.number))
+        self.assertFalse(InvoiceSequence.objects.has_serials())
+
+
+class BulkCreateInvoicesTestCase(TestCase):
+    def testBulkCreateInvoices(self):
+        usr = User.objects.create(username='test')
+        invoices = Invoice.objects.bulk_create_invoices([
+            {'recipient': usr, 'items': [
+                {'description': 'A', 'unit_price': Decimal('2.00'),
+                 'quantity': Decimal('3')},
+                {'description': 'B', 'unit_price': Decimal('1.00')},
+            ]},
+            {'recipient': usr},
+        ])
+        self.assertEquals([inv.number for inv in invoices], [1, 2])
+
+        inv = Invoice.objects.get(pk=invoices[0].pk)
+        self.assertEquals(inv.invoice_id, invoices[0].invoice_id)
+        self.assertEquals(inv.subtotal, Decimal('7.00'))
+        self.assertEquals(inv.compute_totals(), (inv.subtotal,
+                                                 inv.paid_total))
+        self.assertFalse(inv.is_paid)
+
+        inv = Invoice.objects.create(recipient=usr)
+        self.assertEquals(inv.number, 3)
+        self.assertNotEquals(inv.invoice_id, invoices[1].invoice_id)
+
+
+class ImportInvoicesTestCase(TestCase):
+    def testImportCsv(self):
+        usr = User.objects.create(username='test')
+        data = StringIO(
+            "invoice;recipient;invoice_date;description;unit_price;quantity\n"
+            "a;%(pk)s;2015-01-31;Hosting;9.90;2\n"
+            "a;%(pk)s;2015-01-31;Domain;12.00;\n"
+            "b;%(pk)s;2015-02-28;Hosting;9.90;1\n" % {'pk': usr.pk})
+
+        self.assertEquals(import_invoices(read_csv(data), chunk_size=1), 2)
+        invoices = Invoice.objects.order_by('number')
+        self.assertEquals([inv.subtotal for inv in invoices],
+                          [Decimal('31.80'), Decimal('9.90')])
+        self.assertEquals(invoices[0].invoice_date, datetime.date(2015, 1, 31))
+        self.assertEquals(invoices[0].items.count(), 2)
+
+
+class PDFCacheTestCase(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def testFileSystemCache(self):
+        cache = FileSystemPDFCache(self.location, max_size=10)
+        cache.set(1, 'a', '12345')
+        cache.set(2, 'b', '67890')
+        self.assertEquals(cache.get(1, 'a'), '12345')
+        self.assertEquals(cache.get(1, 'b'), None)
+
+        cache.invalidate(1)
+        self.assertEquals(cache.get(1, 'a'), None)
+        self.assertEquals(cache.get(2, 'b'), '67890')
+
+        cache.set(3, 'c', '1234567890')
+        cache.prune()
+        self.assertEquals(cache.get(2, 'b'), None)
+        self.assertEquals(cache.get(3, 'c'), '1234567890')
+
+    def testFingerprintOfPrintedFields(self):
+        class PrintedAddress(object):
+            invoice_address_one = u'Street'
+            invoice_town = u'Town'
+            invoice_postcode = u'PostCode'
+
+        invoice = Invoice.objects.create(recipient=User.objects.create(
+            username='test'))
+        InvoiceItem.objects.create(invoice=invoice, description='A',
+                                   unit_price=Decimal('1.00'))
+        invoice = Invoice.objects.get(pk=invoice.pk)
+        invoice.address = PrintedAddress()
+        cache = FileSystemPDFCache(self.location)
+        key = invoice_fingerprint(invoice)
+        cache.set(invoice.pk, key, render_pdf(invoice))
+
+        # Not drawn by the example layout: the same PDF
+        invoice.paid_total = Decimal('1.00')
+        self.assertEquals(invoice_fingerprint(invoice), key)
+
+        # A printed field changes: a new PDF
+        invoice.address.invoice_town = u'Other town'
+        self.assertNotEquals(invoice_fingerprint(invoice), key)
+        self.assertEquals(cache.get(invoice.pk, invoice_fingerprint(invoice)),
+                          None)
+
+
+class GeneratePDFsTestCase(TestCase):
+    def setUp(self):
+        self.pdf_dir = inv_settings.INV_PDF_DIR
+        inv_settings.INV_PDF_DIR = tempfile.mkdtemp()
+        recipient = User.objects.create(username='test')
+        self.invoices = []
+        for i in range(3):
+            invoice = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=invoice, description='A',
+                                       unit_price=Decimal('1.00'))
+            self.invoices.append(invoice)
+
+    def tearDown(self):
+        shutil.rmtree(inv_settings.INV_PDF_DIR)
+        inv_settings.INV_PDF_DIR = self.pdf_dir
+
+    def testGeneratePDFs(self):
+        report = generate_pdfs(Invoice.objects.all(), processes=1,
+                               chunk_size=2)
+        self.assertEquals((report.generated, report.failed), (3, []))
+        for invoice in self.invoices:
+            with open(invoice.pdf_path(), 'rb') as pdf_file:
+                self.assertEquals(pdf_file.read(5), '%PDF-')
+        self.assertEquals(len(os.listdir(inv_settings.INV_PDF_DIR)), 3)
+
+        report = generate_pdfs(Invoice.objects.all(), processes=1,
+                               missing=True)
+        self.assertEquals((report.generated, report.skipped), (0, 3))
+
+    def testFailedDrawLeavesNoFile(self):
+        def draw_pdf(output, invoice):
+            output.write('%PDF-1.4 partial')
+            raise IOError(u"Drawing failed")
+
+        original = pdf_example.draw_pdf
+        pdf_example.draw_pdf = draw_pdf
+        try:
+            report = generate_pdfs(Invoice.objects.all(), processes=1)
+        finally:
+            pdf_example.draw_pdf = original
+        self.assertEquals(report.generated, 0)
+        self.assertEquals(sorted(report.failed),
+                          [invoice.pk for invoice in self.invoices])
+        self.assertEquals(os.listdir(inv_settings.INV_PDF_DIR), [])
+
+
+class DrawStaticTestCase(TestCase):
+    def testFormDrawnOnce(self):
+        from reportlab.pdfgen.canvas import Canvas
+
+        canvas = Canvas(StringIO())
+        calls = []
+        for page in range(3):
+            draw_static(canvas, 'header', lambda canvas: calls.append(page))
+            canvas.showPage()
+        canvas.save()
+        self.assertEquals(calls, [0])
+
+
+class MultiPagePDFTestCase(TestCase):
+    def setUp(self):
+        self.invoice = Invoice.objects.create(
+            recipient=User.objects.create(username='test'))
+        InvoiceItem.objects.bulk_create([
+            InvoiceItem(invoice=self.invoice, description=u'Call %d' % i,
+                        unit_price=Decimal('0.10'))
+            for i in range(100)])
+
+    def testItemsByChunks(self):
+        items = list(pdf_example.invoice_items(self.invoice, chunk_size=7))
+        self.assertEquals([item.description for item in items],
+                          [u'Call %d' % i for i in range(100)])
+
+    def testPages(self):
+        canvas = pdf_example.draw_pdf(StringIO(), self.invoice)
+        # 28 items on the first page, 37 on the next ones
+        self.assertEquals(canvas.getPageNumber() - 1, 3)
+
+
+class PrintRunTestCase(TestCase):
+    def testVolumes(self):
+        recipient = User.objects.create(username='test')
+        for i in range(3):
+            invoice = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=invoice, description='A',
+                                       unit_price=Decimal('1.00'))
+        directory = tempfile.mkdtemp()
+        try:
+            paths = write_print_run(Invoice.objects.all(),
+                                    os.path.join(directory, 'run.pdf'),
+                                    volume_size=2)
+            self.assertEquals([os.path.basename(path) for path in paths],
+                              ['run-001.pdf', 'run-002.pdf'])
+            for path in paths:
+                with open(path, 'rb') as pdf_file:
+                    self.assertEquals(pdf_file.read(5), '%PDF-')
+        finally:
+            shutil.rmtree(directory)
+
+    def testStreamedZip(self):
+        recipient = User.objects.create(username='test')
+        for i in range(3):
+            invoice = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=invoice, description='A',
+                                       unit_price=Decimal('1.00'))
+        chunks = list(iter_zip(iter_volume_entries(
+            iter_invoices(Invoice.objects.all()), 'run.pdf', volume_size=2)))
+        # One chunk per volume, then the central directory
+        self.assertEquals(len(chunks), 3)
+        archive = zipfile.ZipFile(StringIO(''.join(chunks)))
+        self.assertEquals(archive.namelist(), ['run-001.pdf', 'run-002.pdf'])
+        self.assertEquals(archive.read('run-002.pdf')[:5], '%PDF-')
+
+
+class ServingTestCase(TestCase):
+    def testParseRange(self):
+        self.assertEquals(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEquals(parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEquals(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEquals(parse_range('bytes=900-2000', 1000), (900, 999))
+        self.assertEquals(parse_range('bytes=1000-', 1000), None)
+        self.assertEquals(parse_range('bytes=0-1,5-6', 1000), None)
+
+
+class SpooledBufferTestCase(TestCase):
+    def testSpool(self):
+        content = ''.join([chr(i % 256) for i in range(200000)])
+        with SpooledBuffer(max_size=1000) as buf:
+            buf.write(content[:500])
+            self.assertFalse(buf.spooled)
+            buf.write(content[500:])
+            self.assertTrue(buf.spooled)
+            self.assertEquals(buf.size, len(content))
+            self.assertEquals(''.join(buf.chunks(4096)), content)
+            self.assertEquals(buf.getvalue(), content)
+            self.assertEquals(buf.base64(), content.encode('base64'))
+
+    def testBufferedAttachment(self):
+        usr = User.objects.create(username='test',
+                                  email='example@example.com')
+        invoice = Invoice.objects.create(recipient=usr)
+        InvoiceItem.objects.create(invoice=invoice, description='A',
+                                   unit_price=Decimal('1.00'))
+        pdf = SpooledBuffer(render_pdf(invoice), max_size=1)
+        self.assertTrue(pdf.spooled)
+        email = build_invoice_email(invoice, pdf=pdf)
+        attachment = email.attachments[0]
+        self.assertTrue(attachment.get_payload(decode=True)
+                        .startswith('%PDF'))
+        self.assertTrue(attachment.get_payload() in
+                        email.message().as_string())
+
+
+class SendInvoicesTestCase(TestCase):
+    def testSendInvoices(self):
+        usr = User.objects.create(username='test',
+                                  email='example@example.com')
+        nobody = User.objects.create(username='nobody')
+        for recipient in (usr, usr, nobody):
+            inv = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=inv, description='A',
+                                       unit_price=Decimal('1.00'))
+
+        self.assertEquals(send_invoices(Invoice.objects.all(),
+                                        chunk_size=1), 2)
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(Invoice.objects.filter(invoiced=True).count(), 2)
+        # The PDF buffers are closed once the chunk is sent
+        for email in mail.outbox:
+            self.assertTrue(email.attachments[0].pdf.file.closed)
+
+    def testRenderDeletedInvoice(self):
+        self.assertEquals(render_invoice_pdf(0), None)
+
+    def testFailureMidway(self):
+        class FlakyConnection(object):
+            # Delivers the first message, then fails silently, then raises
+            def __init__(self):
+                self.results = [1, 0]
+
+            def open(self):
+                return False
+
+            def close(self):
+                pass
+
+            def send_messages(self, messages):
+                if not self.results:
+                    raise IOError(u"Connection lost")
+                return self.results.pop(0)
+
+        usr = User.objects.create(username='test',
+                                  email='example@example.com')
+        invoices = []
+        for i in range(4):
+            inv = Invoice.objects.create(recipient=usr)
+            InvoiceItem.objects.create(invoice=inv, description='A',
+                                       unit_price=Decimal('1.00'))
+            invoices.append(inv)
+
+        self.assertRaises(IOError, send_invoices,
+                          Invoice.objects.order_by('pk'), chunk_size=10,
+                          connection=FlakyConnection())
+        self.assertEquals(
+            list(Invoice.objects.filter(invoiced=True)
+                 .values_list('pk', flat=True)), [invoices[0].pk])
+
+    def testInlineImageIsReadOnce(self):
+        fd, path = tempfile.mkstemp(suffix='.gif')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write('GIF89a\x01\x00\x01\x00\x00\x00\x00;')
+        try:
+            image = get_inline_image(path, 'logo')
+            self.assertTrue(get_inline_image(path, 'logo') is image)
+            self.assertEquals(image['Content-ID'], '<logo>')
+        finally:
+            os.remove(path)
+
+
+class SendJobTestCase(TestCase):
+    def setUp(self):
+        usr = User.objects.create(username='test',
+                                  email='example@example.com')
+        nobody = User.objects.create(username='nobody')
+        self.invoices = []
+        for recipient in (usr, usr, nobody):
+            inv = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=inv, description='A',
+                                       unit_price=Decimal('1.00'))
+            self.invoices.append(inv)
+
+    def testRunSendJob(self):
+        job = run_send_job(chunk_size=2, retry_delay=0)
+        self.assertEquals((job.sent_count, job.failed_count), (2, 1))
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(job.status, 'done')
+
+        # Nothing left to send
+        job = run_send_job(retry_delay=0)
+        self.assertEquals(job.sent_count, 0)
+        self.assertEquals(len(mail.outbox), 2)
+
+    def testResumeNeverSendsTwice(self):
+        # A job stopped while sending the first invoice
+        job = SendJob.objects.create(last_invoice=self.invoices[1].pk)
+        SendAttempt.objects.create(job=job, invoice=self.invoices[0],
+                                   status='sending')
+        SendAttempt.objects.create(job=job, invoice=self.invoices[1])
+
+        job = run_send_job(retry_delay=0)
+        self.assertEquals(job.sent_count, 1)
+        self.assertEquals(mail.outbox[0].to, ['example@example.com'])
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(job.attempts.get(invoice=self.invoices[0]).status,
+                          'unknown')
+
+    def testResumeSkipsInvoiced(self):
+        # Sent by another way since the job stopped
+        job = SendJob.objects.create(last_invoice=self.invoices[1].pk)
+        SendAttempt.objects.create(job=job, invoice=self.invoices[0])
+        SendAttempt.objects.create(job=job, invoice=self.invoices[1])
+        Invoice.objects.filter(pk=self.invoices[0].pk).update(invoiced=True)
+
+        job = run_send_job(retry_delay=0)
+        self.assertEquals(job.sent_count, 1)
+        self.assertEquals(len(mail.outbox), 1)
+        attempt = job.attempts.get(invoice=self.invoices[0])
+        self.assertEquals((attempt.status, attempt.error),
+                          ('sent', u"Already invoiced"))
+
+
+class ExportBatchTestCase(TestCase):
+    def setUp(self):
+        self.paid = Invoice.objects.create(recipient=User.objects.create(
+            username='test'))
+        InvoiceItem.objects.create(invoice=self.paid, description='A',
+                                   unit_price=Decimal('10.00'))
+        InvoicePayment.objects.create(invoice=self.paid,
+                                      amount=Decimal('10.00'))
+        self.due = Invoice.objects.create(recipient=self.paid.recipient)
+        InvoiceItem.objects.create(invoice=self.due, description='B',
+                                   unit_price=Decimal('5.00'))
+
+    def testClaimAndRollback(self):
+        export = Export.objects.create(date=datetime.date.today())
+        export.claim(Invoice.objects.filter(is_exported='no'),
+                     InvoicePayment.objects.filter(is_exported=False))
+
+        self.assertEquals(Invoice.objects.get(pk=self.paid.pk).is_exported,
+                          'yes')
+        self.assertEquals(Invoice.objects.get(pk=self.due.pk).is_exported,
+                          'invoice_only')
+        self.assertEquals(export.invoices.count(), 2)
+        self.assertEquals(export.payments.count(), 1)
+
+        export.rollback()
+        self.assertEquals(Invoice.objects.filter(is_exported='no').count(),
+                          2)
+        self.assertEquals(
+            InvoicePayment.objects.filter(is_exported=False).count(), 1)
+        self.assertEquals(Export.objects.count(), 0)
+
+    def testExportJob(self):
+        media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(media_root, 'invoices/export'))
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                export = queue_export()
+                self.assertEquals(export.status, 'pending')
+                self.assertEquals(claim_next_export().pk, export.pk)
+                # Already claimed
+                self.assertEquals(claim_next_export(), None)
+
+                export = run_export(Export.objects.get(pk=export.pk))
+                self.assertEquals(export.status, 'done')
+                self.assertEquals(export.rows_done, 3)
+                self.assertEquals(export.progress(), 100)
+                self.assertTrue(os.path.exists(export.file.path))
+
+                # Nothing left, the export fails and keeps no row
+                export = run_export(queue_export())
+                self.assertEquals(export.status, 'failed')
+                self.assertEquals(export.invoices.count(), 0)
+        finally:
+            shutil.rmtree(media_root)
+
+    def testRecoverStaleExport(self):
+        export = Export.objects.create(date=datetime.date.today(),
+                                       status='running')
+        export.claim(Invoice.objects.filter(is_exported='no'),
+                     InvoicePayment.objects.filter(is_exported=False))
+        # Still alive
+        self.assertEquals(claim_next_export(), None)
+
+        # The worker died two hours ago
+        Export.objects.filter(pk=export.pk).update(
+            modification_date=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEquals(claim_next_export().pk, export.pk)
+        self.assertEquals(Invoice.objects.filter(is_exported='no').count(),
+                          2)
+        self.assertEquals(export.invoices.count(), 0)
+        self.assertEquals(Export.objects.get(pk=export.pk).status, 'running')
+
+    def testDeltaChanges(self):
+        now = timezone.now()
+        first = Export.objects.create(date=now.date(), mode='delta',
+                                      status='done', watermark=now)
+        invoices, payments = first.changes()
+        self.assertEquals((invoices.count(), payments.count()), (2, 1))
+
+        # A payment of an exported invoice changes after the first export
+        InvoicePayment.objects.update(
+            modification_date=now + datetime.timedelta(hours=1))
+        second = Export.objects.create(
+            date=now.date(), mode='delta', status='done',
+            watermark=now + datetime.timedelta(hours=2))
+        self.assertEquals(second.previous_watermark(), now)
+        invoices, payments = second.changes()
+        self.assertEquals((invoices.count(), payments.count()), (0, 1))
+
+
+class ExportWriterTestCase(TestCase):
+    def testJSONLines(self):
+        output = StringIO()
+        writer = JSONLinesWriter(output)
+        writer.write([datetime.date(2014, 2, 5), Decimal('200.00'), u'A "B"'])
+        writer.write([None, Decimal('1.5'), u'C'])
+        self.assertEquals(output.getvalue(),
+                          '["2014-02-05",200.00,"A \\"B\\""]\n'
+                          '[null,1.5,"C"]\n')
+
+    def testFEC(self):
+        output = StringIO()
+        writer = FECWriter(output)
+        row = [u''] * len(FEC_COLUMNS)
+        row[3] = datetime.date(2014, 2, 5)
+        row[10] = u'Invoice | TTH9R'
+        row[11] = Decimal('200.5')
+        writer.write(row)
+        lines = output.getvalue().split('\r\n')
+        self.assertEquals(lines[0], '|'.join(FEC_COLUMNS))
+        fields = lines[1].split('|')
+        self.assertEquals(len(fields), len(FEC_COLUMNS))
+        self.assertEquals(fields[3], '20140205')
+        self.assertEquals(fields[10], 'Invoice   TTH9R')
+        self.assertEquals(fields[11], '200,50')
+
+    def testFECExample(self):
+        invoice = Invoice.objects.create(recipient=User.objects.create(
+            username='test'))
+        InvoiceItem.objects.create(invoice=invoice, description='A',
+                                   unit_price=Decimal('10.00'))
+        InvoicePayment.objects.create(invoice=invoice, amount=Decimal('4.00'))
+        invoice = Invoice.objects.get(pk=invoice.pk)
+        output = StringIO()
+        writer = FECWriter(output)
+        for row in export_example.gather_fec(Invoice.objects.all(),
+                                             InvoicePayment.objects.all()):
+            writer.write(row)
+        lines = output.getvalue().split('\r\n')[1:-1]
+        entries = [dict(zip(FEC_COLUMNS, line.split('|'))) for line in lines]
+        self.assertEquals(
+            [(e['JournalCode'], e['CompteNum'], e['Debit'], e['Credit'])
+             for e in entries],
+            [('VT', '411000', '10,00', '0,00'),
+             ('VT', '706000', '0,00', '10,00'),
+             ('BQ', '512000', '4,00', '0,00'),
+             ('BQ', '411000', '0,00', '4,00')])
+        self.assertEquals(entries[0]['PieceRef'], invoice.invoice_id)
+        self.assertEquals(entries[0]['CompAuxLib'], 'test')
+        self.assertEquals(entries[0]['EcritureDate'],
+                          invoice.invoice_date.strftime('%Y%m%d'))
+
+
+class BenchmarkTestCase(TestCase):
+    def testQueries(self):
+        recipient = User.objects.create(username='test')
+        self.assertEquals(make_fixture(30, recipient, chunk_size=7), 30)
+        # Already there
+        self.assertEquals(make_fixture(30, recipient), 0)
+
+        output = []
+        BENCHMARKS['queries'](output.append, repeat=1)
+        self.assertTrue(output[0].startswith(u'get_due: '))
+
+        delete_fixture()
+        self.assertEquals(Invoice.objects.count(), 0)
+
+        # The fixture numbers are not taken into the real numbering
+        invoice = Invoice.objects.create(recipient=recipient)
+        self.assertEquals(invoice.number, 1)
+
+
+class InvoiceAdminTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                urlresolvers.reverse('admin:invoice_invoice_changelist'))
+        self.assertEquals(response.status_code, 200)
+        return len(queries)
+
+    def add_invoices(self, count):
+        for i in range(count):
+            recipient = User.objects.create(username='client%d-%d' % (
+                Invoice.objects.count(), i))
+            invoice = Invoice.objects.create(recipient=recipient)
+            InvoiceItem.objects.create(invoice=invoice, description='A',
+                                       unit_price=Decimal('10.00'))
+            if i % 2:
+                Invoice.objects.create(recipient=recipient,
+                                       is_credit_note=True,
+                                       invoice_related=invoice)
+
+    def testConstantQueries(self):
+        self.add_invoices(2)
+        queries = self.changelist_queries()
+        self.add_invoices(8)
+        self.assertEquals(self.changelist_queries(), queries)
+
+    def testCreditNoteLink(self):
+        self.add_invoices(2)
+        invoice, with_credit_note = Invoice.objects.filter(
+            is_credit_note=False).order_by('pk')
+        self.assertEquals(invoice.credit_note_related_link(),
+                          invoice.invoice_id)
+        self.assertTrue(with_credit_note.credit_note.invoice_id in
+                        with_credit_note.credit_note_related_link())
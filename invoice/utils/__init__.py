@@ -1,5 +1,10 @@
-from django.http import HttpResponse
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5
+    from django.http import HttpResponse as StreamingHttpResponse
 from ..conf import settings
+from .buffers import SpooledBuffer
 
 
 def format_currency(amount, currency=None):
@@ -11,15 +16,25 @@ def format_currency(amount, currency=None):
     )
 
 
-def pdf_response(draw_funk, file_name, *args, **kwargs):
-    response = HttpResponse(content_type="application/pdf")
+def buffer_response(buf, file_name, content_type="application/pdf"):
+    """
+    Streams the SpooledBuffer ``buf`` as an attachment, the buffer is closed
+    with the response
+    """
+    response = StreamingHttpResponse(buf, content_type=content_type)
+    response["Content-Length"] = buf.size
     response["Content-Disposition"] = "attachment; filename=\"%s\"" % file_name
-    draw_funk(response, *args, **kwargs)
     return response
 
 
+def pdf_response(draw_funk, file_name, *args, **kwargs):
+    buf = SpooledBuffer()
+    draw_funk(buf, *args, **kwargs)
+    return buffer_response(buf, file_name)
+
+
 def send_invoices():
     from ..models import Invoice
+    from ..mailing import send_invoices as send
 
-    for invoice in Invoice.objects.get_due():
-        invoice.send_email()
+    return send(Invoice.objects.get_due())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Byte buffers kept in memory while small and spooled to a temporary file
+above ``INV_PDF_SPOOL_SIZE``, so that a large PDF is never held whole by the
+process on its way to a response, an e-mail or the PDF cache.
+"""
+from base64 import encodestring
+from tempfile import SpooledTemporaryFile
+
+from ..conf import settings as inv_settings
+
+BLOCK_SIZE = 64 * 1024
+# base64 encodes 57 bytes into one line of 76 characters: blocks of a
+# multiple of 57 bytes are encoded separately and joined
+BASE64_BLOCK_SIZE = 57 * 1024
+
+
+class SpooledBuffer(object):
+    """
+    File-like object written once (by ReportLab, the PDF cache...), then read
+    back by blocks as many times as needed. Only one ``chunks()`` iterator
+    may be consumed at a time.
+    """
+    def __init__(self, content=None, max_size=None):
+        if max_size is None:
+            max_size = inv_settings.INV_PDF_SPOOL_SIZE
+        self.file = SpooledTemporaryFile(max_size=max_size)
+        if content:
+            self.write(content)
+
+    def write(self, data):
+        self.file.seek(0, 2)
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    @property
+    def size(self):
+        self.file.seek(0, 2)
+        return self.file.tell()
+
+    @property
+    def spooled(self):
+        """
+        True once the content has been moved to a temporary file
+        """
+        return self.file._rolled
+
+    def chunks(self, chunk_size=BLOCK_SIZE):
+        self.file.seek(0)
+        while True:
+            data = self.file.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def __iter__(self):
+        return self.chunks()
+
+    def write_to(self, fileobj):
+        for chunk in self.chunks():
+            fileobj.write(chunk)
+
+    def base64(self):
+        """
+        :return: string (the content encoded in base64 lines), encoded by
+            blocks without reading the whole content
+        """
+        return ''.join([encodestring(chunk)
+                        for chunk in self.chunks(BASE64_BLOCK_SIZE)])
+
+    def getvalue(self):
+        """
+        :return: string (the whole content), for the consumers which cannot
+            read a file
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
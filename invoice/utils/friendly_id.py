@@ -6,7 +6,9 @@
      Author: Will Hardy
        Date: December 2008
       Usage: >>> encode(1)
-             "488KR"
+             "TTH9R"
+             >>> decode("TTH9R")
+             1
 Description: Invoice numbers like "0000004" are unprofessional in that they
              expose how many sales a system has made, and can be used to monitor
              the rate of sales over a given time.  They are also harder for
@@ -15,10 +17,12 @@ Description: Invoice numbers like "0000004" are unprofessional in that they
              These functions convert an integer (from eg an ID AutoField) to a
              short unique string. This is done simply using a perfect hash
              function and converting the result into a string of user friendly
-             characters.
+             characters. decode() reverses both steps, encode_many() and
+             decode_many() convert lists of numbers or strings.
 
 """
 import math
+from itertools import product
 # import warnings
 
 try:
@@ -78,6 +82,63 @@ def find_suitable_period():
 if not PERIOD:
     PERIOD = find_suitable_period()
 
+BASE = len(VALID_CHARS)
+DIGIT_VALUES = dict((char, value) for value, char in enumerate(VALID_CHARS))
+
+
+def find_string_length():
+    """ The length of the strings is set by STRING_LENGTH or by how many
+        characters are necessary to present a base X representation of SIZE.
+    """
+    length = 0
+    while STRING_LENGTH and length <= STRING_LENGTH or BASE ** length <= SIZE:
+        length += 1
+    return length
+
+
+LENGTH = find_string_length()
+
+
+def find_inverse(factor, modulus):
+    """ Returns the inverse of ``factor`` modulo ``modulus`` (extended
+        Euclidean algorithm), or None if the hash made with ``factor`` is
+        not perfect.
+        With a PERIOD dividing SIZE, this is SIZE + 1 - PERIOD.
+    """
+    inverse, next_inverse = 0, 1
+    rest, next_rest = modulus, factor % modulus
+    while next_rest:
+        quotient = rest // next_rest
+        inverse, next_inverse = next_inverse, inverse - quotient * next_inverse
+        rest, next_rest = next_rest, rest - quotient * next_rest
+    if rest != 1:
+        return None
+    return inverse % modulus
+
+
+INVERSE = find_inverse(SIZE / PERIOD, SIZE + 1)
+
+# encode_many() and decode_many() convert TABLE_DIGITS characters at a time
+TABLE_DIGITS = 3
+_tables = []
+
+
+def get_tables():
+    """ Returns (strings, values): the strings of TABLE_DIGITS characters by
+        value, and the values of the strings of 1 to TABLE_DIGITS characters,
+        built on first use.
+    """
+    if not _tables:
+        strings = [''.join(chars)
+                   for chars in product(VALID_CHARS, repeat=TABLE_DIGITS)]
+        values = {}
+        for digits in range(1, TABLE_DIGITS + 1):
+            values.update((''.join(chars), value) for value, chars in
+                          enumerate(product(VALID_CHARS, repeat=digits)))
+        _tables.append(strings)
+        _tables.append(values)
+    return _tables
+
 
 def perfect_hash(num):
     """ Translate a number to another unique number, using a perfect hash function.
@@ -86,6 +147,17 @@ def perfect_hash(num):
     return ((num + OFFSET) * (SIZE / PERIOD)) % (SIZE + 1) + 1
 
 
+def perfect_unhash(num):
+    """ Inverse of perfect_hash(): returns None if ``num`` is not a hash.
+    """
+    if INVERSE is None:
+        raise ValueError("FRIENDLY_ID_PERIOD=%d does not give a perfect hash "
+                         "for SIZE=%d, it cannot be reversed" % (PERIOD, SIZE))
+    if not 1 <= num <= SIZE + 1:
+        return None
+    return ((num - 1) * INVERSE - OFFSET) % (SIZE + 1)
+
+
 def friendly_number(num):
     """ Convert a base 10 number to a base X string.
         Charcters from VALID_CHARS are chosen, to convert the number
@@ -93,21 +165,36 @@ def friendly_number(num):
         Use valid chars to choose characters that are friendly, avoiding
         ones that could be confused in print or over the phone.
     """
-    # Convert to a (shorter) string for human consumption
-    string = ""
-    # The length of the string can be determined by STRING_LENGTH or by how many
-    # characters are necessary to present a base 30 representation of SIZE.
-    while STRING_LENGTH and len(string) <= STRING_LENGTH \
-            or len(VALID_CHARS) ** len(string) <= SIZE:
-        # PREpend string (to remove all obvious signs of order)
-        string = VALID_CHARS[num % len(VALID_CHARS)] + string
-        num = num / len(VALID_CHARS)
-    return string
-
-
-def encode(num):
+    # Convert to a (shorter) string of LENGTH characters for human
+    # consumption, most significant first (to remove all obvious signs of
+    # order)
+    chars = []
+    for position in range(LENGTH):
+        num, digit = divmod(num, BASE)
+        chars.append(VALID_CHARS[digit])
+    chars.reverse()
+    return ''.join(chars)
+
+
+def unfriendly_number(string):
+    """ Inverse of friendly_number(): returns None if ``string`` holds
+        other characters than VALID_CHARS or has not the right length.
+    """
+    if len(string) != LENGTH:
+        return None
+    num = 0
+    for char in string:
+        digit = DIGIT_VALUES.get(char)
+        if digit is None:
+            return None
+        num = num * BASE + digit
+    return num
+
+
+def encode(num, number=None):
     """ Encode a simple number, using a perfect hash and converting to a
         more user friendly string of characters.
+        ``number`` (the yearly invoice number) is not used.
     """
     # Check the number is within our working range
     if num > SIZE:
@@ -116,3 +203,67 @@ def encode(num):
         return None
 
     return friendly_number(perfect_hash(num))
+
+
+def decode(string):
+    """ Returns the number encoded in ``string``, or None if ``string`` is
+        not an encoded number.
+    """
+    num = unfriendly_number(string)
+    if num is None:
+        return None
+    return perfect_unhash(num)
+
+
+def encode_many(nums, numbers=None):
+    """ Returns the list of encode(num) for ``nums``, converting the hashes
+        TABLE_DIGITS characters at a time through get_tables().
+        ``numbers`` (the yearly invoice numbers) is not used.
+    """
+    strings = get_tables()[0]
+    table_size = len(strings)
+    groups = range(-(-LENGTH // TABLE_DIGITS))
+    factor, modulus = SIZE / PERIOD, SIZE + 1
+    encoded = []
+    for num in nums:
+        if not 0 <= num <= SIZE:
+            encoded.append(None)
+            continue
+        hashed = ((num + OFFSET) * factor) % modulus + 1
+        parts = []
+        for group in groups:
+            hashed, value = divmod(hashed, table_size)
+            parts.append(strings[value])
+        parts.reverse()
+        encoded.append(''.join(parts)[-LENGTH:])
+    return encoded
+
+
+def decode_many(strings):
+    """ Returns the list of decode(string) for ``strings``, converting
+        TABLE_DIGITS characters at a time through get_tables().
+    """
+    if INVERSE is None:
+        perfect_unhash(1)
+    values = get_tables()[1]
+    table_size = BASE ** TABLE_DIGITS
+    # The first group takes the characters left over by the others
+    bounds = [(max(end - TABLE_DIGITS, 0), end)
+              for end in range(LENGTH, 0, -TABLE_DIGITS)]
+    bounds.reverse()
+    inverse, offset, modulus = INVERSE, OFFSET, SIZE + 1
+    decoded = []
+    for string in strings:
+        if len(string) == LENGTH:
+            num = 0
+            for start, end in bounds:
+                value = values.get(string[start:end])
+                if value is None:
+                    break
+                num = num * table_size + value
+            else:
+                if 1 <= num <= modulus:
+                    decoded.append(((num - 1) * inverse - offset) % modulus)
+                    continue
+        decoded.append(None)
+    return decoded
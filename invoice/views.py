@@ -1,31 +1,25 @@
-from django.shortcuts import get_object_or_404
+import json
+
+from django.shortcuts import get_object_or_404, render
+from django.core import urlresolvers
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import HttpResponseRedirect
 from django.utils.translation import ugettext_lazy as _
-from django.http import HttpResponse
-
-from invoice.models import Invoice
-from invoice.pdf import draw_pdf
-from invoice.utils import pdf_response
-from invoice.export import export
+from django.http import HttpResponse, Http404
 
-from os.path import getsize
-from django.core.servers.basehttp import FileWrapper
+from invoice.models import Invoice, Export
+from invoice.pdf_cache import get_pdf_buffer
+from invoice.export import export, queue_export
+from invoice.serving import serve_file
+from invoice.utils import buffer_response
 
 
 def pdf_dl_view(request, pk):
     invoice = get_object_or_404(Invoice, pk=pk)
 
     if invoice.is_pdf_generated():
-        # Serving file is not Django's job
-        # If this need an optimisation, see X-sendfile mod (Apache/nginx)
-        wrapper = FileWrapper(file(invoice.pdf_path()))
-        response = HttpResponse(wrapper, content_type='text/plain')
-        response['Content-Disposition'] = 'attachment; filename="%s"' %\
-            invoice.file_name()
-        response['Content-Length'] = getsize(invoice.pdf_path())
-        return response
+        return serve_file(request, invoice.pdf_path(), invoice.file_name())
     else:
         messages.add_message(request, messages.ERROR,
                              _(u"You have to generate the PDF before!"))
@@ -46,16 +40,40 @@ def pdf_gen_view(request, pk):
 @login_required
 def pdf_user_view(request, invoice_id):
     invoice = get_object_or_404(Invoice, invoice_id=invoice_id)
-    return pdf_response(draw_pdf, invoice.file_name(), invoice)
+    pdf = get_pdf_buffer(invoice)
+    if pdf is None:
+        raise Http404
+    return buffer_response(pdf, invoice.file_name())
 
 
-def export_view(request):
-    try:
-        fileurl = export(test=False)
-        return HttpResponseRedirect(fileurl)
-    except Exception, e:
-        messages.add_message(request, messages.ERROR, e)
-        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+def export_view(request, mode='flags'):
+    # The export is run by the run_export_worker command
+    export = queue_export(mode)
+    return HttpResponseRedirect(urlresolvers.reverse('admin:export_status',
+                                                     args=[export.pk]))
+
+
+def export_status_view(request, pk):
+    export = get_object_or_404(Export, pk=pk)
+    return render(request, 'admin/invoice/export/status.html', {
+        'export': export,
+        'title': _(u"Export %s") % export.pk,
+    })
+
+
+def export_status_json_view(request, pk):
+    export = get_object_or_404(Export, pk=pk)
+    data = {
+        'status': export.status,
+        'status_display': u"%s" % export.get_status_display(),
+        'progress': export.progress(),
+        'rows_done': export.rows_done,
+        'rows_total': export.rows_total,
+        'rows_per_second': export.rows_per_second,
+        'error': export.error,
+        'file_url': export.file.url if export.file else None,
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
 
 
 def export_test_view(request):